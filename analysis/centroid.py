@@ -9,12 +9,17 @@
 #
 # Function List:
 #   hist_median(image)
+#   hist_stats(image, zvalue=3)
 #   fMAD(image)
 #   frobomad(image, thresh=3)
+#   nanrobomad(A, zvalue=3, axis=0)
 #   findstars(input_image, k_thresh=3, k_sigma=3, min_pix_per_star=5, max_pix_per_star=50, 
-#             oblongness=2, mean=None, std=None, debug=False)
+#             oblongness=2, mean=None, std=None, debug=False, backend="dfs")
+#   imgcentroid(image, centers, method="iwc")
+#   batchcentroid(image, centers, method="iwc", scale=1, sigma=2)
 #   iwcentroid(...)
 #   gcentroid
+#   gfitstack(frames, guess, mask=None, maxiter=50, tol=1e-8)
 
 # -------------------------
 # --- IMPORT AND GLOBAL ---
@@ -25,8 +30,10 @@ import sys
 import numpy as np
 import scipy as sci
 from scipy import optimize
+from scipy import ndimage
 import copy as cp
 import time
+import warnings
 import submethods as sm
 
 # -----------------
@@ -40,15 +47,62 @@ def hist_median(image):
     Method derived by: Andrew Zizzi & Kevin Dinkel
     Implemented by: Kevin Dinkel
     '''
-    n = np.size(image)/2
     bins = np.bincount(image.ravel().astype(int))
     
-    ind = 0
-    while n > 0:
-        n -= bins[ind]
-        ind += 1
-    
-    return float(ind-1)
+    return _bins_median(bins, np.size(image))
+
+#-----------------------------------------------------------------------------------------------
+def _bins_median(bins, size):
+    '''
+    Median of size values given their histogram bins (bins[i] = number of values equal to i):
+    the first value at which the cumulative count reaches half of the values.
+    '''
+    return float(np.searchsorted(np.cumsum(bins), size/2))
+
+#-----------------------------------------------------------------------------------------------
+def _histable(image):
+    '''
+    True if the histogram methods apply to image, i.e. it holds non-negative integers.
+    '''
+    kind = np.asarray(image).dtype.kind
+    return kind == 'u' or (kind == 'i' and np.min(image) >= 0)
+
+#-----------------------------------------------------------------------------------------------
+def hist_stats(image, zvalue=3):
+    '''
+    Histogram statistics of an image of non-negative integers. Everything is computed
+    from one bincount of the image, and nothing the size of the image is allocated:
+        m   = histogram median (as hist_median)
+        s   = median absolute deviation (as fMAD)
+        m2  = robust mean and 
+        sd2 = robust standard deviation (as frobomad with the same zvalue)
+    Returns (m, s, m2, sd2).
+    '''
+    size = np.size(image)
+    bins = np.bincount(np.ravel(image))
+    values = np.arange(bins.size)
+    
+    # Median, and the histogram of absolute deviations from it for the MAD
+    m = _bins_median(bins, size)
+    s = _bins_median(np.bincount(abs(values - int(m)), weights=bins), size)
+    sd = 1.4826 * s
+    
+    if (sd < 1.0e-14):
+        return(m, s, m, sd)
+    
+    def _clipped(center, sd):
+        # Mean and std of the values within zvalue*sd of center, from the histogram moments
+        w = bins*(abs(values - center) < (zvalue*sd))
+        n = w.sum()
+        m1 = (w*values).sum()/float(n)
+        sd1 = np.sqrt((w*(values - m1)**2).sum()/n)
+        return m1, sd1
+    
+    # Identify outliers, recompute mean and std with the pixels that remain. Twice.
+    m1, sd1 = _clipped(m, sd)
+    m2, sd2 = _clipped(m1, sd1)
+    
+    return(m, s, m2, sd2)
 
 #-----------------------------------------------------------------------------------------------    
 def fMAD(image):
@@ -56,6 +110,9 @@ def fMAD(image):
     Returns the Medians and Median Absolute Deviation of an array
     using the fast histogram median finding method for images.
     '''
+    if _histable(image):
+        return hist_stats(image)[0:2]
+    
     m = hist_median(image)
     dif = abs(image - m)
     s = hist_median(dif)
@@ -67,9 +124,17 @@ def frobomad(img, zvalue=3, axis=None):
     '''
     Fast and robust estimation of the mean and absolute value of an image.
     Uses fMAD and the histogram median method for speed.
+    
+    With axis set, every row or column is done at once: from per column histograms
+    for non-negative integer images (~30 ms for a 1080x2560 half frame), or with
+    masked reductions for anything else (~200 ms for float frames).
     '''
     
     def _frobomad(image):
+        # Integer images: everything comes straight from the histogram
+        if _histable(image):
+            return hist_stats(image, zvalue)[2:4]
+        
         #STEP 1: Start by getting the median and MAD as robust proxies for the mean and sd.
         m,s = fMAD(image)
         sd = 1.4826 * s
@@ -96,7 +161,7 @@ def frobomad(img, zvalue=3, axis=None):
     
     # NICK'S MOD: Returns frobomad along axis, i.e. for each row or column
     else:        
-        # Reshape image so we can cycle along axis
+        # Reshape image so the axis comes first
         img = np.rollaxis(img, axis)
     
         # Get shape of reshaped array minus the axis dimension,
@@ -104,20 +169,170 @@ def frobomad(img, zvalue=3, axis=None):
         sh = img.shape[1:]
         l = img.shape[0]
         
-        # Preallocate mean and std vectors
-        m = np.zeros((img.size/l, 1))
-        sd = np.zeros((img.size/l, 1))
-
-        # Reshape the array so it is 2D, and find the median of each row.
-        for ii,row in enumerate(img.reshape(l,-1).T):
-            (m[ii], sd[ii]) = _frobomad(row)        
+        # Reshape the array so it is 2D, and find the robust mean of every column at once.
+        cols = img.reshape(l,-1)
+        if _histable(cols):
+            (m, sd) = _hist_frobomad_cols(cols, zvalue)
+        else:
+            (m, sd) = _frobomad_cols(cols, zvalue)
 
         # Return the medians        
         return (m.reshape(sh), sd.reshape(sh) )
+
+#-----------------------------------------------------------------------------------------------
+def _hist_frobomad_cols(cols, zvalue=3):
+    '''
+    frobomad of every column of a 2D array of non-negative integers, computed from a
+    per column histogram (one bincount of the whole array). Same method as hist_stats.
+    '''
+    (l, k) = cols.shape
+    n = l/2
+    
+    # The histograms run from the smallest value to a cap well above the bulk of the
+    # image; anything brighter (stars, hot pixels) is lumped into one overflow bin.
+    gbins = np.cumsum(np.bincount(cols.ravel()))
+    lo = int(np.argmax(gbins > 0))
+    hi = len(gbins) - 1
+    gmed = np.searchsorted(gbins, gbins[-1]/2)
+    cap = min(max(2*np.searchsorted(gbins, 0.99*gbins[-1]) - gmed, lo), hi) - lo
+    nbins = cap + 2
+    
+    # The histograms and their three cumulative sums are k*nbins each; past ~16M bins
+    # (a wide spread of values over many columns) the masked reductions are cheaper
+    if k*nbins > 2**24:
+        return _frobomad_cols(cols, zvalue)
+    values = np.arange(nbins)
+    
+    # Histogram of every column, as rows of a (k, nbins) array
+    offset = np.arange(k)*nbins
+    capped = np.minimum(cols, cap + lo + 1) if cap + lo < hi else cols
+    bins = np.bincount((capped + (offset - lo)).ravel(), minlength=k*nbins).reshape(k, nbins)
+    
+    # Cumulative counts and moments of every histogram, so that any window of
+    # values is summed with two lookups
+    c0 = np.cumsum(bins, axis=1)
+    c1 = np.cumsum(bins*values, axis=1)
+    c2 = np.cumsum(bins*values**2, axis=1)
+    rows = np.arange(k)
+    
+    def _window(c, first, last):
+        # Sum of the histogram values first..last (inclusive) of each column
+        tot = c[rows, np.clip(last, 0, nbins-1)] - np.where(first > 0, c[rows, np.clip(first-1, 0, nbins-1)], 0)
+        return np.where(last >= first, tot, 0)
+    
+    # Median: first value with cumulative count >= n
+    m = np.argmax(c0 >= n, axis=1)
+    
+    # MAD: smallest s with at least n values in m-s..m+s. Bisect on s, all columns at once.
+    slo = np.zeros(k, dtype=int)
+    shi = np.zeros(k, dtype=int) + (nbins - 1)
+    while np.any(slo < shi):
+        mid = (slo + shi)/2
+        enough = _window(c0, m - mid, m + mid) >= n
+        shi = np.where(enough, mid, shi)
+        slo = np.where(enough, slo, mid + 1)
+    sd = 1.4826 * slo
+    
+    def _clipped(center, sd):
+        # Mean and std of the values within zvalue*sd of center, from the histogram moments
+        first = np.int64(np.floor(center - zvalue*sd)) + 1
+        last = np.int64(np.ceil(center + zvalue*sd)) - 1
+        n = np.float64(_window(c0, first, last))
+        m1 = _window(c1, first, last)/n
+        sd1 = np.sqrt(np.maximum(_window(c2, first, last)/n - m1**2, 0))
+        return m1, sd1, last
+    
+    # Identify outliers, recompute mean and std with the pixels that remain. Twice.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m1, sd1, last1 = _clipped(m, sd)
+        m2, sd2, last2 = _clipped(m1, sd1)
+    
+    # Columns whose windows reached the overflow bin are redone exactly
+    over = (m + slo > cap) | (last1 > cap) | (last2 > cap)
+    
+    flat = sd < 1.0e-14
+    m = np.where(flat, m, m2) + lo
+    sd = np.where(flat, sd, sd2)
+    if np.any(over):
+        (m[over], sd[over]) = _frobomad_cols(cols[:,over], zvalue)
+    return (m, sd)
+
+#-----------------------------------------------------------------------------------------------
+def _frobomad_cols(cols, zvalue=3):
+    '''
+    frobomad of every column of a 2D array, with masked reductions. The medians are the
+    same (truncated to integers) as hist_median would give for each column. This is the
+    path for float frames, and it is several times slower than _hist_frobomad_cols
+    (~200 ms against ~30 ms for a 1080x2560 half frame).
+    '''
+    (l, k) = cols.shape
+    n = max(l/2, 1)
+    
+    # Median and MAD of every column, partitioned along contiguous int32 rows
+    m = np.float64(np.partition(cols.T.astype(np.int32), n-1, axis=1)[:,n-1])
+    s = np.partition(abs(cols.T - m[:,None]).astype(np.int32), n-1, axis=1)[:,n-1]
+    sd = 1.4826 * s
+    
+    def _clipped(center, sd):
+        # Mean and std of the pixels within zvalue*sd of center, summed in float64 from
+        # the offsets to center (in the array's own precision)
+        y = cols - center.astype(cols.dtype)
+        good = abs(y) < (zvalue*sd).astype(cols.dtype)
+        y *= good
+        n = good.sum(axis=0, dtype=np.int64)
+        d1 = y.sum(axis=0, dtype=np.float64)/n
+        d2 = np.einsum('ij,ij->j', y, y, dtype=np.float64)/n
+        return center + d1, np.sqrt(np.maximum(d2 - d1**2, 0))
+    
+    # Identify outliers, recompute mean and std with the pixels that remain. Twice.
+    if cols.dtype.kind != 'f':
+        cols = np.float64(cols)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        m1, sd1 = _clipped(m, sd)
+        m2, sd2 = _clipped(m1, sd1)
+    
+    flat = sd < 1.0e-14
+    return (np.where(flat, m, m2), np.where(flat, sd, sd2))
     
 		
 #-----------------------------------------------------------------------------------------------
-def findstars(input_image, zreject=3, zthresh=3, zpeakthresh=5, min_pix_per_star=6, max_pix_per_star=50, oblongness=1.5, mean=None, std=None, debug=False):
+def nanrobomad(A, zvalue=3, axis=0):
+    '''
+    Robust mean and standard deviation along an axis of an array, computed for every
+    row/column at once. This is the same estimate as chzphot.robomad (median and MAD, then
+    two rounds of sigma clipping), but NaN entries are treated as missing, so ragged sets of
+    pixels can be padded out to one array. Slices with no valid pixels return NaN.
+    '''
+    A = np.asarray(A, dtype=np.float64)
+    
+    def _clipped(center, sd):
+        # Mean and std of the pixels within zvalue*sd of center (NaNs never pass the cut)
+        good = abs(A - center) < zvalue*sd
+        n = good.sum(axis=axis, keepdims=True)
+        m1 = np.where(good, A, 0).sum(axis=axis, keepdims=True)/n
+        sd1 = np.sqrt(np.where(good, (A - m1)**2, 0).sum(axis=axis, keepdims=True)/n)
+        return m1, sd1
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            #STEP 1: Start by getting the median and MAD as robust proxies for the mean and sd.
+            m = np.nanmedian(A, axis=axis, keepdims=True)
+            sd = 1.4826 * np.nanmedian(abs(A - m), axis=axis, keepdims=True)
+            
+            #STEP 2 and 3: Recompute mean and std twice, without the outliers.
+            m1, sd1 = _clipped(m, sd)
+            m2, sd2 = _clipped(m1, sd1)
+    
+    # Flat slices keep the median
+    flat = sd < 1.0e-14
+    m2 = np.where(flat, m, m2)
+    sd2 = np.where(flat, sd, sd2)
+    
+    return (np.squeeze(m2, axis=axis), np.squeeze(sd2, axis=axis))
+    
+#-----------------------------------------------------------------------------------------------
+def findstars(input_image, zreject=3, zthresh=3, zpeakthresh=5, min_pix_per_star=6, max_pix_per_star=50, oblongness=1.5, mean=None, std=None, debug=False, backend="dfs", background=None):
     '''
     Given an image, this function will return a set of approximate star centers and their widths in the following form:
     
@@ -136,6 +351,12 @@ def findstars(input_image, zreject=3, zthresh=3, zpeakthresh=5, min_pix_per_star
                 mean = use this mean as the robust estimation for the background instead of calculating it
                  std = use this standard deviation as the robust estimateion for the background standard deviation
                        instead of calculating it
+             backend = "dfs" grows each star with a depth first search from its bright pixels. "label" finds
+                       every 8-connected blob above the limit in one pass with scipy.ndimage.label and measures
+                       all of them at once with array reductions, which is much faster on crowded frames.
+          background = (bg, rms) maps from submethods.bgmesh, used as a per pixel mean and std for images with
+                       a varying background. The peak of each star is then tested against its own local
+                       background. Needs backend "label".
     '''
     def _findStars(limit):
         '''
@@ -242,9 +463,61 @@ def findstars(input_image, zreject=3, zthresh=3, zpeakthresh=5, min_pix_per_star
                     star_centers.append(cog(blob))
 
         return star_centers
-               
-    # First. lets make a local copy of our image:
-    image = cp.deepcopy(input_image)
+
+    def _labelStars(limit):
+        '''
+        Find stars based on calculated background limit, by labeling all of the connected
+        blobs of pixels above the limit at once. The same cuts as dfs() are applied to each blob.
+        '''
+        # Label 8-connected blobs:
+        mask = image > limit
+        labels, nblobs = ndimage.label(mask, structure=np.ones((3,3)))
+        if nblobs == 0:
+            return []
+
+        # Pixels of every blob, sorted so each blob's pixels are contiguous:
+        rows, cols = mask.nonzero()
+        blob = labels[rows, cols]
+        order = np.argsort(blob, kind='mergesort')
+        blob = blob[order]
+        rows = rows[order]
+        cols = cols[order]
+        value = np.float64(image[rows, cols])
+
+        # Per blob pixel count, peak, extent and intensity weighted center of gravity:
+        n = np.bincount(blob)[1:]
+        start = np.concatenate(([0], np.cumsum(n)[:-1]))
+        peak = np.maximum.reduceat(value, start)
+        xsize = np.float64(np.maximum.reduceat(rows, start) - np.minimum.reduceat(rows, start))
+        ysize = np.float64(np.maximum.reduceat(cols, start) - np.minimum.reduceat(cols, start))
+        flux = np.bincount(blob, value)[1:]
+        xc = np.bincount(blob, value*cols)[1:]/flux
+        yc = np.bincount(blob, value*rows)[1:]/flux
+
+        # Is the peak pixel bright enough, is the blob star sized and is it round enough?
+        if np.ndim(mean):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                good = np.maximum.reduceat((value - mean[rows, cols])/std[rows, cols], start) >= zpeakthresh
+        else:
+            good = (peak >= mean + zpeakthresh*std)
+        good &= (n >= min_pix_per_star) & (n <= max_pix_per_star)
+        good &= (np.minimum(xsize, ysize) > 0)
+        good &= (np.maximum(xsize, ysize) <= oblongness*np.minimum(xsize, ysize))
+
+        return [((x,y),(wx,wy)) for x,y,wx,wy in zip(xc[good], yc[good], ysize[good], xsize[good])]
+
+    if backend not in ("dfs", "label"):
+        raise RuntimeError("Bad backend. Choices are ""dfs"" and ""label""")
+    if background is not None:
+        if backend != "label":
+            raise RuntimeError("A background map needs backend ""label""")
+        (mean, std) = background
+
+    # First. lets make a local copy of our image (dfs zeroes out the pixels it visits):
+    if backend == "dfs":
+        image = cp.deepcopy(input_image)
+    else:
+        image = input_image
     
     # Get the robust mean and standard deviation:
     tic = time.clock()
@@ -261,15 +534,16 @@ def findstars(input_image, zreject=3, zthresh=3, zpeakthresh=5, min_pix_per_star
         print 'robust mean: ' + str(mean) + ' robust std: ' + str(std)
     
     # Define the star limit:
-    limit = mean + zthresh*std
-    if limit < 1:
-        limit = 1
+    limit = np.maximum(mean + zthresh*std, 1)
     if debug:
         print 'limit: ' + str(limit)
     
     # Identify stars in the frame:
     tic = time.clock()
-    centroid_guesses = _findStars(limit)
+    if backend == "dfs":
+        centroid_guesses = _findStars(limit)
+    else:
+        centroid_guesses = _labelStars(limit)
     toc = time.clock()
     
     if debug:
@@ -288,12 +562,11 @@ def imgcentroid(image, centers, method="iwc"):
     # Initialize list of refined centroids
     star_list = []
     
-    for star in centers:
-        (centroid, width) = star           
-            
-        # Use the first centroid to test      
-        (frame, (xframe,yframe), frame_centroid) = sm.windowsub(image, centroid, width, neg=True, scale=1)
-                                
+    # Background subtracted windows of all the stars
+    windows = sm.batchwindowsub(image, centers, neg=True, scale=1)
+    
+    for (frame, (xframe,yframe), frame_centroid) in windows:
+        
         # Get centroid
         if method is "cog":
             frame[(frame < 0).nonzero()] = 0
@@ -310,6 +583,145 @@ def imgcentroid(image, centers, method="iwc"):
         
     return star_list        
                 
+#-----------------------------------------------------------------------------------------------
+# Status flags returned by batchcentroid
+CENT_OK = 0         # centroid is good
+CENT_EDGE = 1       # window was cut off by the edge of the image
+CENT_NOFLUX = 2     # no flux left in the window after background subtraction
+CENT_NOFIT = 4      # gaussian fit did not converge
+CENT_STRADDLE = 8   # window straddles the middle of the sensor (two readout halves)
+
+def batchcentroid(image, centers, method="iwc", scale=1, sigma=2, background=None):
+    '''
+    Refines all of the centroids in centers (as returned by findstars) at once. This
+    does the same job as imgcentroid, but instead of calling windowsub for each star,
+    every star window is cut out into one padded (nstars, h, w) stack and the whole
+    stack is processed with a few array operations:
+    
+      * window size is (2*int(scale*width)+1) in x and y, as in windowsub
+      * the background of each window column is the robust mean (nanrobomad, with 
+        sigma clipping) of the two search bands of 2*int(scale*height) rows directly above 
+        and below the window, using only rows in the same sensor half as the star (and,
+        as in windowsub, not the row just above the middle when a bottom band runs past
+        it), so positions agree with imgcentroid to rounding. The exception is a window
+        that straddles the middle: windowsub slices its two halves with image row
+        numbers, so for any window not starting at row 0 it subtracts nothing at all,
+        while batchcentroid subtracts the background of the star's half. Those stars
+        can disagree by the whole background and are flagged CENT_STRADDLE.
+      * method "cog" or "iwc" computes the center of mass with intensity weight 1 or 2
+      * method "gauss" fits a gaussian to every window at once with gfitstack, starting 
+        from the IWC center and the second moment widths
+      * background = (bg, rms) maps from submethods.bgmesh skips the search bands, and
+        subtracts bg pixel by pixel instead
+    
+    Returns a structured array with one row per star and the fields:
+        x, y   = refined centroid in image coordinates
+        flux   = background subtracted flux in the window
+        width  = flux weighted rms radius of the star [pixels]
+        status = CENT_OK, or a combination of the flags CENT_EDGE, CENT_NOFLUX, CENT_NOFIT
+                 and CENT_STRADDLE
+                 (x, y and width are NaN for CENT_NOFLUX)
+    '''
+    result = np.zeros(len(centers), dtype=[('x', np.float64), ('y', np.float64), ('flux', np.float64),
+                                           ('width', np.float64), ('status', np.int32)])
+    if len(centers) == 0:
+        return result
+    
+    if method == "cog":
+        p = 1
+    elif method in ("iwc", "gauss"):
+        p = 2
+    else:
+        raise RuntimeError("Bad method. Choices are ""cog"", ""iwc"" and  ""gauss""")
+    
+    # Image size
+    (ysize, xsize) = image.shape
+    middle = int(ysize/2)
+    
+    # Star positions and window half widths
+    ((x, y), (w, h)) = [np.array(v, dtype=np.float64).T for v in zip(*centers)]
+    w = np.int_(scale*w)
+    h = np.int_(scale*h)
+    
+    # Window boundaries, before and after clipping to the image
+    left = np.int_(x) - w
+    top = np.int_(y) - h
+    right = np.int_(x) + w + 1
+    bottom = np.int_(y) + h + 1
+    L = np.maximum(left, 0)
+    T = np.maximum(top, 0)
+    R = np.minimum(right, xsize)
+    B = np.minimum(bottom, ysize)
+    
+    # Row and column indices of the padded window stack (nstars, rows) and (nstars, cols)
+    rows = T[:,None] + np.arange((B - T).max())
+    cols = L[:,None] + np.arange((R - L).max())
+    inrows = rows < B[:,None]
+    incols = cols < R[:,None]
+    rows = np.minimum(rows, ysize-1)
+    cols = np.minimum(cols, xsize-1)
+    
+    if background is None:
+        # Search band rows above and below each window, kept in the star's sensor half
+        k = np.arange(2*h.max())
+        lo = np.where(y < middle, 0, middle)[:,None]
+        hi = np.where(y < middle, np.where(B + 2*h > middle, middle-1, middle), ysize)[:,None]
+        brows = np.hstack((T[:,None] - 2*h[:,None] + k, B[:,None] + k))
+        inband = np.hstack((k < 2*h[:,None], k < 2*h[:,None])) & (brows >= lo) & (brows < hi)
+        brows = np.clip(brows, 0, ysize-1)
+        
+        # Per column robust background of every window
+        bands = np.float64(image[brows[:,:,None], cols[:,None,:]])
+        bands[~inband] = np.nan
+        bg = nanrobomad(bands, sigma, axis=1)[0]
+        bg[np.isnan(bg)] = 0
+        bg = bg[:,None,:]
+    else:
+        # Background map under every window
+        bg = np.float64(background[0][rows[:,:,None], cols[:,None,:]])
+    
+    # Background subtracted windows, with padding and negative values zeroed
+    frames = np.float64(image[rows[:,:,None], cols[:,None,:]]) - bg
+    inframe = inrows[:,:,None] & incols[:,None,:]
+    frames[~inframe] = 0
+    if method == "gauss":
+        fitframes = frames.copy()
+    frames[frames < 0] = 0
+    
+    # Intensity weighted moments of the whole stack
+    Y = np.arange(frames.shape[1])[None,:,None]
+    X = np.arange(frames.shape[2])[None,None,:]
+    flux = frames.sum(axis=(1,2))
+    values = frames**p
+    valsum = values.sum(axis=(1,2))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xf = (X*values).sum(axis=(1,2))/valsum
+        yf = (Y*values).sum(axis=(1,2))/valsum
+        r2 = (frames*((X - xf[:,None,None])**2 + (Y - yf[:,None,None])**2)).sum(axis=(1,2))/flux
+    
+    width = np.sqrt(r2)
+    status = np.where((L != left) | (T != top) | (R != right) | (B != bottom), CENT_EDGE, CENT_OK)
+    status |= np.where(valsum > 0, CENT_OK, CENT_NOFLUX)
+    status |= np.where((T < middle) & (B >= middle), CENT_STRADDLE, CENT_OK)
+    
+    # Gaussian fit, starting from the moments
+    if method == "gauss":
+        fit = (status & CENT_NOFLUX) == 0
+        guess = np.column_stack((frames.max(axis=(1,2)), xf, yf, width/np.sqrt(2), width/np.sqrt(2)))
+        params, converged, cov = gfitstack(fitframes[fit], guess[fit], inframe[fit])
+        xf[fit] = params[:,1]
+        yf[fit] = params[:,2]
+        width[fit] = np.sqrt((params[:,3]**2 + params[:,4]**2)/2)
+        status[fit] |= np.where(converged, CENT_OK, CENT_NOFIT)
+    
+    result['x'] = xf + L
+    result['y'] = yf + T
+    result['flux'] = flux
+    result['width'] = width
+    result['status'] = status
+    
+    return result
+    
 #-----------------------------------------------------------------------------------------------
 def iwcentroid(frame, p=2):
     '''
@@ -359,6 +771,85 @@ def gcentroid(frame, (x0,y0)):
     
     return (xf,yf), success
 
+#-----------------------------------------------------------------------------------------------
+def gfitstack(frames, guess, mask=None, maxiter=50, tol=1e-8):
+    '''
+    Fits the gaussian defined by gaussian() to every frame of a (nstars, h, w) stack at
+    once, with a Levenberg-Marquardt iteration that runs on all of the stars together and 
+    uses the closed form Jacobian of the gaussian. guess is the (nstars, 5) array of 
+    starting parameters p = (amp, xcenter, ycenter, xwidth, ywidth), in frame coordinates.
+    mask is an optional boolean stack, False for padding pixels that should not be fit.
+    
+    Returns:
+        p         = (nstars, 5) array of fitted parameters
+        converged = boolean array, True for stars whose fit converged
+        cov       = (nstars, 5, 5) covariance matrices of the fitted parameters
+    '''
+    frames = np.asarray(frames, dtype=np.float64)
+    p = np.array(guess, dtype=np.float64).reshape(-1, 5)
+    nstars = frames.shape[0]
+    if nstars == 0:
+        return p, np.zeros(0, dtype=bool), np.zeros((0, 5, 5))
+    if mask is None:
+        mask = np.ones(frames.shape, dtype=bool)
+    
+    Y = np.arange(frames.shape[1])[None,:,None]
+    X = np.arange(frames.shape[2])[None,None,:]
+    
+    def _model(p):
+        # Gaussian of every star and its Jacobian (nstars, 5, h, w), zeroed outside the mask
+        amp, xc, yc, wx, wy = [a[:,None,None] for a in p.T]
+        u = (xc - X)/wx
+        v = (yc - Y)/wy
+        E = np.exp(-0.5*(u**2 + v**2))*mask
+        G = amp*E
+        J = np.array([E, -G*u/wx, -G*v/wy, G*u**2/wx, G*v**2/wy]).swapaxes(0,1)
+        return G, J
+    
+    def _cost(G):
+        return (((G - frames)*mask)**2).sum(axis=(1,2))
+    
+    G, J = _model(p)
+    cost = _cost(G)
+    lam = np.ones(nstars)*1.0e-3
+    converged = np.zeros(nstars, dtype=bool)
+    eye = np.eye(5)
+    
+    for ii in range(maxiter):
+        # Normal equations of every star (damped by lam)
+        r = (G - frames)*mask
+        JTJ = np.einsum('nihw,njhw->nij', J, J)
+        g = np.einsum('nihw,nhw->ni', J, r)
+        A = JTJ + lam[:,None,None]*JTJ*eye + 1.0e-12*eye
+        step = -np.linalg.solve(A, g[:,:,None])[:,:,0]
+        step[converged] = 0
+        
+        # Take the step where it lowers the cost
+        ptry = p + step
+        Gtry, Jtry = _model(ptry)
+        with np.errstate(invalid='ignore'):
+            ctry = _cost(Gtry)
+        better = (ctry <= cost) & ~converged
+        
+        # Converged when the cost (or the step) stops changing
+        done = better & ((cost - ctry <= tol*cost) | (abs(step) <= tol*(abs(p) + tol)).all(axis=1))
+        
+        p[better] = ptry[better]
+        G[better] = Gtry[better]
+        J[better] = Jtry[better]
+        cost[better] = ctry[better]
+        lam = np.where(better, lam/10, lam*10)
+        converged |= done
+        if converged.all():
+            break
+    
+    # Covariance from the final Jacobian and the residual variance
+    JTJ = np.einsum('nihw,njhw->nij', J, J)
+    dof = np.maximum(mask.sum(axis=(1,2)) - 5, 1)
+    cov = np.linalg.pinv(JTJ)*(cost/dof)[:,None,None]
+    
+    return p, converged, cov
+
 #-----------------------------------------------------------------------------------------------
 def gaussian(amp, xcent, ycent, wx, wy):
     '''
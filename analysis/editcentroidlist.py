@@ -6,14 +6,15 @@
 
 import math
 import numpy as np
-import copy as cp
+from scipy.spatial import cKDTree
 
 def matchstars(centlistA,centlistB,searchradius=25):
     '''starrcorr(): Returns a list of tuples containing two (x,y) touples for matched star 
     positions between frames A and B. The left (x,y) tuple is for frame A, right for frame B
     >>> a = correlateframes(centlistA,centlistB)
     >>> print a[0]
-    >>> ((xA,yA),(xB,yB)) # but with numbers''' 
+    >>> ((xA,yA),(xB,yB)) # but with numbers
+    The stars are paired by matchindices() (one to one, in the order of list A).''' 
     
     # checks
     if centlistA == [] or centlistB == []: 
@@ -22,17 +23,84 @@ def matchstars(centlistA,centlistB,searchradius=25):
     if type(centlistA[0]) is not tuple and type(centlistB[0]) is not tuple:            
         raise RuntimeError('matchstars(): type tuple expected inside centroid lists')
         
-    # go through list A one at a time, remove matched stars from B
-    matchedlist = []
-    Bcopy = cp.deepcopy(centlistB) # use copy of centlistB so as not to edit original list
-    
-    for posA in centlistA:
-        matchindex = matchsearch(posA,Bcopy,searchradius) # look for a match in centlistB
-        if matchindex: # if there's a match remove matched pos in B and continue on in A
-            matchedlist.append((posA,Bcopy[matchindex]))
-            Bcopy.remove(Bcopy[matchindex])
-                            
-    return matchedlist
+    (ia, ib) = matchindices(centlistA, centlistB, searchradius)
+    return [(centlistA[i], centlistB[j]) for i, j in zip(ia, ib)]
+
+def matchindices(centlistA, centlistB, searchradius=25, method="greedy"):
+    '''matchindices(): Matches stars between frames A and B, given as lists of (x,y) or (N,2)
+    arrays, and returns the index arrays (ia, ib) of the matched pairs, so that star ia[k] 
+    of A is star ib[k] of B. Stars are only matched within searchradius of each other, 
+    using a KD-tree over frame B.
+    
+    method = "greedy" goes through A in order, and gives each star the closest star in B 
+             that has not been matched yet (the matchstars() rule)
+             "mutual" only keeps pairs that are each other's nearest neighbor
+    >>> (ia, ib) = matchindices(A, B, 5)
+    >>> dxy = B[ib] - A[ia]'''
+    
+    A = np.reshape(np.asarray(centlistA, dtype=np.float64), (-1, 2))
+    B = np.reshape(np.asarray(centlistB, dtype=np.float64), (-1, 2))
+    nA = len(A)
+    nB = len(B)
+    if nA == 0 or nB == 0:
+        return (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    
+    # The tree only returns neighbors strictly closer than the bound, nudge it to include
+    # stars exactly searchradius away
+    bound = searchradius*(1 + 1e-9) + 1e-12
+    treeB = cKDTree(B)
+    
+    if method == "mutual":
+        (dA, jA) = treeB.query(A, distance_upper_bound=bound)
+        (dB, jB) = cKDTree(A).query(B, distance_upper_bound=bound)
+        ia = ((dA <= searchradius) & (jA < nB)).nonzero()[0]
+        ia = ia[jB[jA[ia]] == ia]
+        return (ia, jA[ia])
+    
+    elif method == "greedy":
+        # A few nearest candidates for every star in A, closest first (ties by index in B)
+        k = min(8, nB)
+        (d, j) = treeB.query(A, k=k, distance_upper_bound=bound)
+        (d, j) = (d.reshape(nA, k), j.reshape(nA, k))
+        rows = np.arange(nA)[:,None]
+        order = np.lexsort((j, d), axis=1)
+        (d, j) = (d[rows, order], j[rows, order])
+        
+        # Nobody wants the same star: every star simply gets its closest one
+        found = (j[:,0] < nB) & (d[:,0] <= searchradius)
+        if len(np.unique(j[found,0])) == found.sum():
+            ia = found.nonzero()[0]
+            return (ia, j[ia,0])
+        
+        taken = np.zeros(nB, dtype=bool)
+        ia = []
+        ib = []
+        for i in range(nA):
+            match = None
+            for (dist, jj) in zip(d[i], j[i]):
+                if jj == nB or dist > searchradius:
+                    break
+                if not taken[jj]:
+                    match = jj
+                    break
+            else:
+                # Every candidate was taken, look through all of the stars in range
+                ball = np.array(treeB.query_ball_point(A[i], bound), dtype=int)
+                ball = ball[~taken[ball]]
+                if len(ball):
+                    dist = np.hypot(*(B[ball] - A[i]).T)
+                    keep = dist <= searchradius
+                    (ball, dist) = (ball[keep], dist[keep])
+                    if len(ball):
+                        match = ball[np.lexsort((ball, dist))[0]]
+            if match is not None:
+                taken[match] = True
+                ia.append(i)
+                ib.append(match)
+        return (np.array(ia, dtype=int), np.array(ib, dtype=int))
+    
+    else:
+        raise RuntimeError('matchindices(): method must be "greedy" or "mutual"')
     
 # Supporting funcitons
 def matchsearch(posA,centlistB,r):
@@ -67,13 +135,61 @@ def dist(x1,x2,y1,y2):
     
 
 # ----------------- 2D to 3D ----------------------
-def project3D(centlist,vpix=2160,hpix=2560,plate_scale=6.5,f=150000):
-    '''project3D(): given list of centroid pairs ((xA,yA),(xB,yB)) matched between frames, 
-    returns list of 3D tuples pairs ((xA,yA,zA),(xB,yB,zB))
+class CameraModel(object):
+    '''CameraModel: camera intrinsics for turning image positions into unit vectors.
+    f = focal length in microns
+    plate_scale = microns/pixel
+    cx, cy = principal point [pixels], the sensor center (hpix/2, vpix/2) by default
+    k1, k2 = radial distortion terms. An image offset r (in units of f) from the
+    principal point is scaled by (1 + k1*r**2 + k2*r**4).
+    
+    The 3D frame is the one described in project3D(): x is forward out of the image,
+    y is left (decreasing columns) and z is up (decreasing rows).
+    >>> camera = CameraModel(f=150000, plate_scale=6.5)
+    >>> V = camera.project(xy)     # (N,2) pixel positions -> (N,3) unit vectors'''
+    
+    def __init__(self, f=150000, plate_scale=6.5, cx=None, cy=None, hpix=2560, vpix=2160, k1=0, k2=0):
+        self.f = float(f)
+        self.plate_scale = float(plate_scale)
+        self.cx = hpix/2. if cx is None else float(cx)
+        self.cy = vpix/2. if cy is None else float(cy)
+        self.k1 = float(k1)
+        self.k2 = float(k2)
+    
+    def project(self, xy):
+        '''project(): returns the unit vectors of image positions xy, an array of shape 
+        (..., 2) of (x,y) pairs in pixels (an (N,2) list of stars, an (N,2,2) stack of 
+        matched pairs, ...), as a float64 array of shape (..., 3).'''
+        xy = np.asarray(xy, dtype=np.float64)
+        
+        # Offsets from the principal point [microns], in the y (left) and z (up) directions
+        y = (self.cx - xy[...,0])*self.plate_scale
+        z = (self.cy - xy[...,1])*self.plate_scale
+        
+        # Radial distortion
+        if self.k1 or self.k2:
+            r2 = (y*y + z*z)/(self.f*self.f)
+            scale = 1 + self.k1*r2 + self.k2*r2*r2
+            y = y*scale
+            z = z*scale
+        
+        # Focus vector and image offsets, normalized
+        V = np.empty(xy.shape[:-1] + (3,))
+        C = 1/np.sqrt(self.f*self.f + y*y + z*z)
+        V[...,0] = C*self.f
+        V[...,1] = -C*y
+        V[...,2] = -C*z
+        return V
+
+def project3D(centlist,vpix=2160,hpix=2560,plate_scale=6.5,f=150000,camera=None):
+    '''project3D(): given centroids, returns their 3D unit vectors as a float64 array. 
+    centlist is an (N,2) array (or list) of (x,y) positions, or a stack of pairs 
+    ((xA,yA),(xB,yB)) of shape (N,2,2); the result has shape (N,3) or (N,2,3).
     vpix = vertical pixels
     hpix = horizontal pixels
     plate_scale = microns/pixel
     f = focal length in microns
+    camera = CameraModel to use instead of the four numbers above
     
     This function converts from the image (X,Y) frame to the 3D (x,y,z) frame. 
     In the image frame, positive X represents increasing columns, while increasing
@@ -94,38 +210,15 @@ def project3D(centlist,vpix=2160,hpix=2560,plate_scale=6.5,f=150000):
     
     To convert to this new frame, we think of centroid pairs as converting from
     (X,Y) to (-y,-z)
+    
+    Without a camera, this keeps the numbers it has always given: the CMOS center 
+    (plate_scale*hpix/2, plate_scale*vpix/2) is in microns but the centroids are 
+    used in pixels, which is a CameraModel with that principal point and plate_scale 1.
     '''
-        
-    def pos2Dto3D((xi,yi)):
-        '''pos2Dto3D(): returns (x,y,z) given (x,y)'''
-        
-        # CMOS center and shifted (X,Y) coords
-        xp = plate_scale*hpix/2; #x-center [microns]
-        yp = plate_scale*vpix/2; #y-center [microns]
-        
-        x = (xp-xi)
-        y = (yp-yi)
-        
-        # Focus vector, image vector, and 3D vector magnitude
-        ff = f*f
-        xx = x*x
-        yy = y*y
-        C = 1/math.sqrt(ff + xx + yy)
-       
-        # New version - see comments above
-        xv = C*f
-        yv = -C*x
-        zv = -C*y
-        
-        # Old version - keeps x and y in image frame
-        #xv = C*x
-        #yv = C*y
-        #zv = C*f
-
-        return xv,yv,zv
-
-    return map(pos2Dto3D,centlist)
-
+    if camera is None:
+        camera = CameraModel(f=f, plate_scale=1, cx=plate_scale*hpix/2., cy=plate_scale*vpix/2.)
+    
+    return camera.project(centlist)
 
 '''
 # Test this shit
@@ -29,24 +29,204 @@ def qmethod(Vi, Vb, W=None):
     
     The body vectors Vi and Vb must be of size Nx3, where N is the number of
     vectors. 2D cases should set the third column to zero. 
+    
+    This is qmethod_batch() for a single frame pair, so the quaternion [x,y,z,w]
+    has the same sign convention (w >= 0).
     '''
 
-    Vi = array( Vi )
-    Vb = array( Vb )
+    Vi = array( Vi, dtype=float64 )
+    Vb = array( Vb, dtype=float64 )
     
-    # Calculate components of K    
-    S, Z, tr = qmatrices(Vi, Vb, W)
+    # Check vector sizes and weights
+    if Vi.shape != Vb.shape:
+        raise RuntimeError('Must have same number of body and inertial vectors')
+    if W is not None:
+        if W.shape != (Vi.shape[0], 1):
+            raise RuntimeError('Weight vector must have same length as row in Vb, Vi')
+        W = W.T
+    
+    return qmethod_batch(Vi[newaxis], Vb[newaxis], W)[0]
+    
+# -------------------------------------------------------------------------------
+def qmethod_batch(Vi, Vb, W=None):
+    '''
+    Solves the q-method for N frame pairs at once. Vi and Vb are stacks of inertial
+    and body vectors of size NxMx3, where M is the number of vectors per pair, and
+    W is an NxM array of weights (all ones by default). Returns an Nx4 array of 
+    best fit quaternions [x,y,z,w], signed so that w >= 0.
+    
+    Pairs with fewer than M vectors are padded with zero vectors (see padvectors()),
+    which add nothing to K. A pair with no vectors at all gives [0,0,0,1].
+    
+    All the K matrices are built with einsum and solved with one symmetric 
+    eigenvalue call, so a whole burst is a handful of array operations.
+    '''
+    
+    Vi = asarray( Vi, dtype=float64 )
+    Vb = asarray( Vb, dtype=float64 )
+    
+    # Check vector sizes
+    if Vi.shape != Vb.shape or Vi.ndim != 3 or Vi.shape[2] != 3:
+        raise RuntimeError('Vi and Vb must both be of size NxMx3')
     
-    # K Matrix
-    K = array( vstack([ hstack( [S - tr*eye(3), Z] ), append(Z.T, tr) ]) )
+    # B matrices, B = Vb.T * W * Vi for every pair
+    if W is None:
+        B = einsum('nmi,nmj->nij', Vb, Vi)
+    else:
+        W = asarray( W, dtype=float64 )
+        if W.shape != Vi.shape[:2]:
+            raise RuntimeError('Weight array must be of size NxM')
+        B = einsum('nm,nmi,nmj->nij', W, Vb, Vi)
     
-    # Eigenvalues and vectors
-    w,v = linalg.eig(K)
+    # K matrices, [[S - tr*I, Z], [Z.T, tr]]
+    tr = B[:,0,0] + B[:,1,1] + B[:,2,2]
+    K = empty( (B.shape[0], 4, 4) )
+    K[:,:3,:3] = B + B.transpose(0,2,1)
+    K[:,[0,1,2],[0,1,2]] -= tr[:,newaxis]
+    K[:,3,3] = tr
+    K[:,:3,3] = K[:,3,:3] = column_stack( [B[:,1,2] - B[:,2,1], B[:,2,0] - B[:,0,2], B[:,0,1] - B[:,1,0]] )
     
-    # Best fit quaternion
-    Q = v[:,argmax(w)]
+    # Eigenvalues come out in ascending order, so the last eigenvector is the best fit
+    w,v = linalg.eigh(K)
+    Q = v[:,:,-1]
     
-    return Q    
+    # Sign convention: positive scalar part
+    Q *= where(Q[:,3] < 0, -1.0, 1.0)[:,newaxis]
+    
+    return Q
+    
+# -------------------------------------------------------------------------------
+def padvectors(Vlist):
+    '''
+    Stacks a list of N vector sets of size Mix3 into an NxMx3 array, padding the
+    shorter sets with zero vectors, for qmethod_batch().
+    '''
+    
+    Vlist = [reshape( asarray(V, dtype=float64), (-1,3) ) for V in Vlist]
+    counts = [len(V) for V in Vlist]
+    
+    V = zeros( (len(Vlist), max(counts + [0]), 3) )
+    for (ii, Vi) in enumerate(Vlist):
+        V[ii,:counts[ii]] = Vi
+    
+    return V
+    
+# -------------------------------------------------------------------------------
+def robustqmethod(Vi, Vb, W=None, threshold=1e-5, hypotheses=1000, iterations=5):
+    '''
+    Outlier-robust q-method (RANSAC). Vi and Vb are Nx3 inertial and body vectors
+    and W is an optional length N vector of weights, e.g. the centroid SNR or flux
+    of each star. threshold is the largest residual [radians] of an inlier.
+    
+    Each hypothesis is the exact rotation through a minimal set of two vector pairs
+    (TRIAD on the pair's sum and cross product). Every pair is tried when there are
+    at most "hypotheses" of them, otherwise "hypotheses" random pairs are drawn. All
+    hypotheses are solved and scored at once; the score is the sum of the inlier
+    weights. The best inlier set is then refit with the weighted q-method, and the
+    inliers redrawn from its residuals, up to "iterations" times. If no hypothesis
+    finds at least two inliers with weight, every pair is used (the plain weighted
+    q-method).
+    
+    Returns the quaternion [x,y,z,w] (w >= 0), the boolean inlier mask and the 
+    residual angle of every vector pair [radians].
+    '''
+    
+    Vi = reshape( asarray(Vi, dtype=float64), (-1,3) )
+    Vb = reshape( asarray(Vb, dtype=float64), (-1,3) )
+    if Vi.shape != Vb.shape:
+        raise RuntimeError('Must have same number of body and inertial vectors')
+    
+    n = Vi.shape[0]
+    if W is None:
+        W = ones(n)
+    else:
+        W = reshape( asarray(W, dtype=float64), -1 )
+        if W.shape != (n,):
+            raise RuntimeError('Weight vector must have same length as row in Vb, Vi')
+    
+    # Nothing to vote on with fewer than three pairs
+    if n < 3:
+        q = qmethod_batch(Vi[newaxis], Vb[newaxis], W[newaxis])[0]
+        res = residuals(q, Vi, Vb)
+        return q, ones(n, dtype=bool), res
+    
+    # Minimal sets: every pair, or a random draw of distinct pairs
+    if n*(n - 1)/2 <= hypotheses:
+        (ii, jj) = triu_indices(n, 1)
+    else:
+        ii = random.randint(0, n, hypotheses)
+        jj = (ii + random.randint(1, n, hypotheses)) % n
+    
+    # Hypothesis rotations and their residual cosines, H hypotheses by N vectors:
+    # vb.R*vi is the sum of R[i,j]*vb[i]*vi[j], one matrix product for them all
+    R = triad(Vi[ii], Vi[jj], Vb[ii], Vb[jj])
+    
+    # Pairs of (nearly) parallel vectors have no rotation
+    R = R[isfinite(R[:,0,0])]
+    if R.shape[0] == 0:
+        inliers = ones(n, dtype=bool)
+    else:
+        cosines = dot( R.reshape(-1,9), (Vb[:,:,newaxis]*Vi[:,newaxis,:]).reshape(-1,9).T )
+        inliers = cosines > cos(threshold)
+        scores = dot(inliers.astype(float64), W)
+        best = argmax(scores)
+        inliers = inliers[best]
+        # No hypothesis with a real consensus: plain weighted q-method on every pair
+        if scores[best] <= 0 or inliers.sum() < 2:
+            inliers = ones(n, dtype=bool)
+    
+    # Refit on the inliers until they stop changing
+    for kk in range(iterations):
+        q = qmethod_batch(Vi[newaxis], Vb[newaxis], (W*inliers)[newaxis])[0]
+        res = residuals(q, Vi, Vb)
+        update = res < threshold
+        if update.sum() < 2 or array_equal(update, inliers):
+            break
+        inliers = update
+    
+    return q, inliers, res
+    
+# -------------------------------------------------------------------------------
+def triad(vi1, vi2, vb1, vb2):
+    '''
+    Rotation matrices R (Hx3x3) with R*vi = vb for H minimal sets of two vector
+    pairs, each Hx3. The triads are built on the sum and cross product of each
+    pair, so both vectors are treated alike. Parallel pairs give nan.
+    '''
+    
+    def frame(v1, v2):
+        # Columns a1 = v1 + v2, a2 = v1 x v2 and a3 = a1 x a2, normalized
+        T = empty( v1.shape + (3,) )
+        a1 = T[:,:,0]
+        a2 = T[:,:,1]
+        a3 = T[:,:,2]
+        add(v1, v2, out=a1)
+        for (i, j, k) in ((0,1,2), (1,2,0), (2,0,1)):
+            a2[:,i] = v1[:,j]*v2[:,k] - v1[:,k]*v2[:,j]
+        a1 /= sqrt( einsum('hi,hi->h', a1, a1) )[:,newaxis]
+        a2 /= sqrt( einsum('hi,hi->h', a2, a2) )[:,newaxis]
+        for (i, j, k) in ((0,1,2), (1,2,0), (2,0,1)):
+            a3[:,i] = a1[:,j]*a2[:,k] - a1[:,k]*a2[:,j]
+        return T
+    
+    old = seterr(invalid='ignore', divide='ignore')
+    try:
+        A = frame(vi1, vi2)
+        B = frame(vb1, vb2)
+    finally:
+        seterr(**old)
+    
+    return matmul(B, A.transpose(0,2,1))
+    
+# -------------------------------------------------------------------------------
+def residuals(q, Vi, Vb):
+    '''
+    Angle [radians] between each body vector and the inertial vector rotated by q.
+    '''
+    
+    d = dot(Vi, quat2rot(q).T) - Vb
+    
+    return 2*arcsin( minimum(sqrt( sum(d*d, axis=1) )/2, 1) )
     
 # -------------------------------------------------------------------------------
 def quest(Vi, Vb, W=None):
@@ -174,6 +354,40 @@ def main():
     print 'Q Method takes: ' + str( (t2 - t1)*1000)
     print 'QUEST takes: ' + str( (t3 - t2)*1000)
     
+    # A burst of 1000 frame pairs of 20 vectors, one pair at a time and batched
+    n = 1000
+    Vi = random.normal(size=(n, 20, 3))
+    Vi /= sqrt( sum(Vi*Vi, axis=2) )[:,:,newaxis]
+    Vb = einsum('ij,nmj->nmi', R_calc, Vi) + random.normal(scale=1e-4, size=Vi.shape)
+    
+    t1 = time.time()
+    q_loop = array( [qmethod(Vi[ii], Vb[ii]) for ii in range(n)] )
+    t2 = time.time()
+    q_batch = qmethod_batch(Vi, Vb)
+    t3 = time.time()
+    
+    print ''
+    print 'Q Method, ' + str(n) + ' pairs one at a time takes: ' + str( (t2 - t1)*1000)
+    print 'Q Method, ' + str(n) + ' pairs batched takes: ' + str( (t3 - t2)*1000)
+    print 'Largest difference: ' + str( abs(q_loop - q_batch).max() )
+    
+    # One frame pair of 30 stars within a degree of the boresight, three of them mismatched
+    Vi = column_stack( [ones(30), random.uniform(-0.01, 0.01, size=(30, 2))] )
+    Vi /= sqrt( sum(Vi*Vi, axis=1) )[:,newaxis]
+    Vb = dot(Vi, quat2rot(q_actual/linalg.norm(q_actual)).T) + random.normal(scale=1e-6, size=Vi.shape)
+    Vb[:3] = Vb[3:6]
+    
+    t1 = time.time()
+    q_robust, inliers, res = robustqmethod(Vi, Vb)
+    t2 = time.time()
+    q_calc = qmethod(Vi, Vb)
+    
+    print ''
+    print 'Robust Q Method takes: ' + str( (t2 - t1)*1000)
+    print 'Inliers: ' + str(inliers.sum()) + ' of ' + str(len(inliers))
+    print 'Error, robust: ' + str( abs(q_robust - q_actual/linalg.norm(q_actual)).max() )
+    print 'Error, plain:  ' + str( abs(q_calc - q_actual/linalg.norm(q_actual)).max() )
+    
     return 0
     
     
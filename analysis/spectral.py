@@ -0,0 +1,130 @@
+# File: spectral.py
+# Created: 10/18/2026
+#
+# Power spectra: welch(), welch_bursts()
+#
+# Description: This module provides Welch power spectral densities for
+# attitude series (a single series, a (3,N) yaw/pitch/roll array or a stack
+# of them) and for batches of bursts of different lengths. The window, its
+# normalization and the frequency axis of each segment length are set up
+# once and cached, and the FFTs can run in float32.
+#
+# Example:
+#   >>> (freqs, psd) = spectral.welch(angles, fs=10, nperseg=256)   # angles is (3,N)
+#   >>> (freqs, psds) = spectral.welch_bursts({172: angles172, 175: angles175}, fs=10)
+#   >>> psds[172][0]                                                 # yaw PSD [rad^2/Hz]
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import signal as signal
+from scipy import fftpack as fftpack
+
+# Cached (window, scale, freqs) of each (nperseg, window, fs, scaling, dtype)
+_welchplans = {}
+
+def _welchplan(nperseg, window, fs, scaling, dtype):
+    '''Window, PSD scale factor and frequency axis for segments of nperseg samples.'''
+    key = (nperseg, window, fs, scaling, np.dtype(dtype).str)
+    if key not in _welchplans:
+        win = signal.get_window(window, nperseg).astype(dtype)
+        if scaling == 'density':
+            scale = 1.0/(fs*np.sum(np.float64(win)**2))
+        elif scaling == 'spectrum':
+            scale = 1.0/np.sum(np.float64(win))**2
+        else:
+            raise ValueError('Unknown scaling: %s' % scaling)
+        freqs = np.arange(nperseg//2 + 1)*(fs/float(nperseg))
+        _welchplans[key] = (win, scale, freqs)
+    return _welchplans[key]
+
+def _rfftpower(segments):
+    '''|rfft|^2 of the last axis, from the packed real output of fftpack.rfft (which
+    keeps float32 input in float32).'''
+    n = segments.shape[-1]
+    y = fftpack.rfft(segments, axis=-1, overwrite_x=True)
+    power = np.empty(y.shape[:-1] + (n//2 + 1,), dtype=y.dtype)
+    power[..., 0] = y[..., 0]**2
+    # y = [y(0), Re y(1), Im y(1), ..., Re y(n/2)] for even n, [..., Im y((n-1)/2)] for odd
+    pairs = y[..., 1:1 + 2*((n - 1)//2)]
+    power[..., 1:1 + (n - 1)//2] = pairs[..., 0::2]**2 + pairs[..., 1::2]**2
+    if n % 2 == 0:
+        power[..., -1] = y[..., -1]**2
+    return power
+
+def welch(series, fs=1.0, nperseg=256, noverlap=None, window='hann', detrend='constant',
+          scaling='density', dtype=np.float64):
+    '''Welch power spectral density of the last axis of series: a single series, a (3,N)
+    yaw/pitch/roll array, or any stack of series of the same length.
+
+    fs = sampling frequency [Hz], 1/delta_t
+    nperseg = samples per segment (at most the series length)
+    noverlap = samples shared by neighbouring segments, nperseg/2 by default
+    window = scipy.signal.get_window() window
+    detrend = 'constant', 'linear' or False, applied to each segment
+    scaling = 'density' [units^2/Hz] or 'spectrum' [units^2]
+    dtype = np.float32 halves the memory and FFT time of long batches
+
+    Returns (freqs, psd): the one sided frequency axis [Hz] and the segment averaged
+    PSD, of shape series.shape[:-1] + (nperseg/2 + 1,). The results are the same as
+    scipy.signal.welch() with the same arguments.'''
+    x = np.asarray(series, dtype=dtype)
+    n = x.shape[-1]
+    nperseg = int(nperseg)
+    if nperseg > n:
+        raise ValueError('nperseg (%d) is longer than the series (%d)' % (nperseg, n))
+    if noverlap is None:
+        noverlap = nperseg//2
+    step = nperseg - int(noverlap)
+    if step <= 0:
+        raise ValueError('noverlap must be less than nperseg')
+    (win, scale, freqs) = _welchplan(nperseg, window, fs, scaling, x.dtype)
+
+    # Segments as a strided view, (..., nseg, nperseg)
+    nseg = (n - nperseg)//step + 1
+    x = np.ascontiguousarray(x)
+    segments = as_strided(x, shape=x.shape[:-1] + (nseg, nperseg),
+                          strides=x.strides[:-1] + (step*x.strides[-1], x.strides[-1]))
+
+    # Detrend (makes the copy the FFT works in) and window
+    if detrend == 'constant':
+        segments = segments - segments.mean(axis=-1)[..., np.newaxis]
+    elif detrend == 'linear':
+        segments = signal.detrend(segments, axis=-1, type='linear').astype(x.dtype)
+    elif not detrend:
+        segments = segments.copy()
+    else:
+        raise ValueError('Unknown detrend: %s' % detrend)
+    segments *= win
+
+    # Average the segment powers; one sided, so every frequency but 0 and Nyquist
+    # counts twice
+    psd = _rfftpower(segments).mean(axis=-2)
+    psd *= scale
+    if nperseg % 2 == 0:
+        psd[..., 1:-1] *= 2
+    else:
+        psd[..., 1:] *= 2
+
+    return freqs, psd.astype(x.dtype)
+
+def welch_bursts(bursts, fs=1.0, nperseg=256, **kwargs):
+    '''welch() of many bursts that may differ in length, e.g. the (3,N) attitude angles
+    of every night burst. bursts is a dictionary {burst_num: series} or a list of
+    series; every burst shares the cached window and frequency axis.
+
+    Returns (freqs, psds), with psds a dictionary {burst_num: psd} (or a list) of the
+    PSDs. keyword arguments are passed on to welch().'''
+    if isinstance(bursts, dict):
+        keys = sorted(bursts)
+        psds = {}
+    else:
+        keys = range(len(bursts))
+        psds = [None]*len(bursts)
+
+    freqs = None
+    for key in keys:
+        if np.shape(bursts[key])[-1] < nperseg:
+            raise ValueError('Burst %s has fewer than nperseg (%d) samples' % (key, nperseg))
+        (freqs, psds[key]) = welch(bursts[key], fs=fs, nperseg=nperseg, **kwargs)
+
+    return freqs, psds
@@ -3,27 +3,25 @@
 # Created: 10/8/12
 # Modified: 12/28/2012
 #
-# Subtraction methods: colmeansub(), windowsub(), darkcolsub(obsolete)
+# Subtraction methods: colmeansub(), windowsub(), bgmesh(), darkcolsub(obsolete)
 #
 # Description: This module provides methods for image background/noise
 # subtraction. "colmeansub" subtracts the column means from the whole
-# image. "windowsub" subtracts means only in a specified window.
+# image. "windowsub" subtracts means only in a specified window. "bgmesh"
+# maps a spatially varying background from robust statistics on a grid of tiles.
 
 import numpy as np
-import chzphot as chzphot
 import copy as cp
 import centroid as centroid
+from scipy import ndimage
 
 # ----------- unit16 subtraction ---------------
-def subtract_uint16(a, b):
+def subtract_uint16(a, b, out=None):
     '''Subtraction to avoid overflow problems and negatives. If the difference a-b 
-    is less than 0 it is assigned the value 0.'''
-    A = int(a) # signed int32
-    B = int(b) # signed int32
-    if A-B < 0:
-        return (np.uint16(0)) # return 0
-    else:
-        return (a-b)
+    is less than 0 it is assigned the value 0. Works on scalars or arrays (b is 
+    broadcast against a, e.g. a row of column averages), and writes into out if it 
+    is given, which can be a itself.'''
+    return np.subtract(a, np.minimum(a, b), out=out)
 
 # ----------------------- Background Subtraction -----------------------------
 def bgsub(imgArray):
@@ -49,6 +47,79 @@ def bgsub(imgArray):
     # Subtract from image and return
     return img  
 
+# ----------------------- Background Mesh -----------------------------
+def bgmesh(imgArray, tile=(60,64), filtersize=3, zvalue=3):
+    '''
+    Returns smooth background and rms maps (float32, the size of the image) for
+    images whose background varies across the frame, like daytime sky. Each sensor
+    half is cut into a grid of tile[0] x tile[1] pixel tiles, and the robust mean
+    and std (frobomad) of every tile are found at once. The tile grids are median
+    filtered over filtersize x filtersize tiles, to drop tiles spoiled by bright
+    stars, and interpolated bilinearly between the tile centers.
+    
+    The maps can be subtracted (meshsub), or used as the star thresholds in
+    findstars and as the window backgrounds in batchcentroid:
+    >>> bgmap = submethods.bgmesh(image)
+    >>> centers = centroid.findstars(image, background=bgmap, backend="label")
+    >>> stars = centroid.batchcentroid(image, centers, background=bgmap)
+    '''
+    (ysize, xsize) = imgArray.shape
+    middle = int(ysize/2)
+    
+    bg = np.empty((ysize, xsize), dtype=np.float32)
+    rms = np.empty((ysize, xsize), dtype=np.float32)
+    for (start, stop) in ((0, middle), (middle, ysize)):
+        half = imgArray[start:stop]
+        (th, tw) = (min(tile[0], half.shape[0]), min(tile[1], half.shape[1]))
+        (m, sd) = _tilestats(half, (th, tw), zvalue)
+        if filtersize > 1:
+            m = ndimage.median_filter(m, filtersize, mode='nearest')
+            sd = ndimage.median_filter(sd, filtersize, mode='nearest')
+        bg[start:stop] = _interptiles(m, half.shape, (th, tw))
+        rms[start:stop] = _interptiles(sd, half.shape, (th, tw))
+    
+    return (bg, rms)
+
+def _tilestats(half, (th, tw), zvalue=3):
+    '''Robust mean and std of every th x tw tile of half, as (ny, nx) grids. Pixels 
+    past the last whole tile are left out of the statistics.'''
+    (ny, nx) = (half.shape[0]/th, half.shape[1]/tw)
+    
+    # One column per tile
+    tiles = half[:ny*th, :nx*tw].reshape(ny, th, nx, tw).transpose(1, 3, 0, 2).reshape(th*tw, ny*nx)
+    (m, sd) = centroid.frobomad(tiles, zvalue, axis=0)
+    m = m.reshape(ny, nx)
+    sd = sd.reshape(ny, nx)
+    
+    # Tiles without a usable estimate take the typical value
+    m[np.isnan(m)] = np.nanmedian(m)
+    sd[np.isnan(sd)] = np.nanmedian(sd)
+    return (m, sd)
+
+def _interptiles(grid, shape, (th, tw)):
+    '''Bilinear interpolation of a grid of tile values to every pixel of an image of
+    the given shape. Pixels beyond the outer tile centers take the edge values.'''
+    def _weights(n, size, ntiles):
+        # Tile coordinate of every pixel, and the two nearest tiles
+        t = np.clip((np.arange(n) + 0.5)/size - 0.5, 0, ntiles - 1)
+        i0 = np.int_(t)
+        i1 = np.minimum(i0 + 1, ntiles - 1)
+        return (i0, i1, np.float32(t - i0))
+    
+    (y0, y1, fy) = _weights(shape[0], th, grid.shape[0])
+    (x0, x1, fx) = _weights(shape[1], tw, grid.shape[1])
+    grid = np.float32(grid)
+    rows = grid[y0]*(1 - fy)[:,None] + grid[y1]*fy[:,None]
+    return rows[:,x0]*(1 - fx) + rows[:,x1]*fx
+
+def meshsub(imgArray, **kwargs):
+    '''
+    Subtracts the background map of bgmesh (called with kwargs) from the image, and
+    returns the float32 result.
+    '''
+    (bg, rms) = bgmesh(imgArray, **kwargs)
+    return np.subtract(imgArray, bg, dtype=np.float32)
+
 # ----------------------- Column Mean Subtraction -----------------------------
 def colmeansub(imgArray):
     '''
@@ -91,25 +162,15 @@ def colmeansub(imgArray):
     return img  
  
 # ----------------------------- Window Subtraction ---------------------------------    
-def windowsub(image,(x,y),(w,h), scale=1.5, sigma=2, neg=False):
-    '''windowsub(): Returns the subtracted image window around a star and the location of the
-    top left corner of the window.'''
-    
-    # spans top & bottom halves - get medians and subtract from separate halves
-    # on left or right side - return what's possible
-    # on top or bottom  - return what's possible 
-    
-    # image size
-    (ysize, xsize) = image.shape
+def _windowbounds((x,y),(w,h), scale, (ysize, xsize)):
+    '''_windowbounds(): Window and search band limits of windowsub(), as 
+    ((windowL, windowR, windowT, windowB), (TT, TB), (BT, BB), straddle).'''
     middle = int(ysize/2)
     
     # ensure centroid is in image
     if x > xsize-1 or y > ysize-1:
         raise RuntimeError('Invalid star position (x,y)')
     
-    # copy image
-    img = cp.deepcopy(image)  
-    
     # Widths to use
     w = int(scale*w)
     h = int(scale*h)
@@ -117,8 +178,8 @@ def windowsub(image,(x,y),(w,h), scale=1.5, sigma=2, neg=False):
     # window area for subtraction and returning:
     windowL = int(x) - w
     windowR = int(x) + w + 1
-    windowT = y - h
-    windowB = y + h + 1
+    windowT = int(y) - h
+    windowB = int(y) + h + 1
     
     if windowL < 0: windowL = 0
     if windowR > xsize: windowR = xsize
@@ -126,57 +187,109 @@ def windowsub(image,(x,y),(w,h), scale=1.5, sigma=2, neg=False):
     if windowB > ysize: windowB = ysize
             
     # top search area
-    TL = windowL
-    TR = windowR
     TT = windowT - 2*h
     TB = windowT
     
     if TT < 0: TT = 0
     
     # bottom search area
-    BL = windowL
-    BR = windowR
     BT = windowB
     BB = windowB + 2*h
 
     if BB > ysize: BB = ysize
-        
-    # define window from image
-    window = img[windowT:windowB, windowL:windowR]
+    
+    # if window on both halves, the halves are handled separately
+    straddle = windowT < middle and windowB >= middle
+    if not straddle:
+        # Check that the search zones are in the same half
+        if middle-1 in range(np.int16(TT),np.int16(TB)): TT = middle
+        if middle in range(np.int16(BT),np.int16(BB)): BB = middle-1
+    
+    return ((windowL, windowR, windowT, windowB), (TT, TB), (BT, BB), straddle)
+
+def windowsub(image,(x,y),(w,h), scale=1.5, sigma=2, neg=False):
+    '''windowsub(): Returns the subtracted image window around a star and the location of the
+    top left corner of the window. Only the window is copied out of the image, and the robust
+    background of all of its columns is found at once from the search bands above and below it
+    (centroid.nanrobomad, the same estimate as chzphot.robomad).'''
+    
+    # spans top & bottom halves - get medians and subtract from separate halves
+    # on left or right side - return what's possible
+    # on top or bottom  - return what's possible 
+    
+    # image size
+    (ysize, xsize) = image.shape
+    middle = int(ysize/2)
+    
+    ((windowL, windowR, windowT, windowB), (TT, TB), (BT, BB), straddle) = \
+        _windowbounds((x,y), (w,h), scale, (ysize, xsize))
+    
+    # copy the window from the image
+    window = np.array(image[windowT:windowB, windowL:windowR])
     
     # if window on both halves    
     # use top and bottom halve independently for cols, 
     # subtract seperately in parts of window 
-    if windowT < middle and windowB >= middle:
-        searchT = cp.deepcopy( image[TT:TB, TL:TR] )
-        searchB = cp.deepcopy( image[BT:BB, BL:BR] )
-        rowsT = searchT.shape[0]
-        rowsB = searchB.shape[0]
-        
-        for col in range(0, window.shape[1]):
-            colmT,s = chzphot.robomad(searchT[:,col], sigma)
-            colmB,s = chzphot.robomad(searchB[:,col], sigma)
-            window[windowT:middle][:,col] = window[windowT:middle][:,col]-colmT # top
-            window[middle:windowB][:,col] = window[middle:windowB][:,col]-colmB # bottom
+    if straddle:
+        # The parts of the window are indexed with image rows (as they always have been),
+        # so for a window away from the image top they are empty and nothing is subtracted.
+        top = window[windowT:middle]
+        bottom = window[middle:windowB]
+        if top.size:
+            top[...] = top - centroid.nanrobomad(image[TT:TB, windowL:windowR], sigma)[0]
+        if bottom.size:
+            bottom[...] = bottom - centroid.nanrobomad(image[BT:BB, windowL:windowR], sigma)[0]
             
     # window is on a single half
     else:
-        # Check that the search zones are in the same half
-        if middle-1 in range(np.int16(TT),np.int16(TB)): TT = middle
-        if middle in range(np.int16(BT),np.int16(BB)): BB = middle-1
-        
-        searchT = img[TT:TB, TL:TR]
-        searchB = img[BT:BB, BL:BR]
-        search = np.vstack((searchT,searchB)) 
-
-        for col in range(0, window.shape[1]):            
-            colm,s = chzphot.robomad(search[:,col], sigma)
-            window[:, col] = window[:, col]-colm
+        search = np.vstack((image[TT:TB, windowL:windowR], image[BT:BB, windowL:windowR]))
+        window[...] = window - centroid.nanrobomad(search, sigma)[0]
     
     # Remove negative values
     if neg is False:  window[(window < 0).nonzero()] = 0
             
     return (window, (windowL, windowT), (x - windowL, y - windowT))   
+
+def batchwindowsub(image, windows, scale=1.5, sigma=2, neg=False):
+    '''batchwindowsub(): windowsub() for a list of windows, given either as (x, y, w, h) or 
+    as the ((x,y),(w,h)) star tuples of centroid.findstars(). The search bands of all of the
+    windows are padded into one stack, so the column backgrounds of every window come from
+    a single centroid.nanrobomad() call. Returns the list of windowsub() results.'''
+    
+    (ysize, xsize) = image.shape
+    windows = np.reshape(np.array(windows, dtype=np.float64), (-1, 4))
+    results = [None]*len(windows)
+    
+    # Limits of every window. Windows across the middle are rare, leave them to windowsub.
+    single = []
+    for ii, (x, y, w, h) in enumerate(windows):
+        bounds = _windowbounds((x,y), (w,h), scale, (ysize, xsize))
+        if bounds[3]:
+            results[ii] = windowsub(image, (x,y), (w,h), scale, sigma, neg)
+        else:
+            single.append((ii, bounds))
+    if not single:
+        return results
+    
+    # Search bands of all the windows, NaN padded to one (nwindows, rows, cols) stack
+    nrows = max((TB - TT) + (BB - BT) for ii, (win, (TT, TB), (BT, BB), s) in single)
+    ncols = max(win[1] - win[0] for ii, (win, tb, bb, s) in single)
+    bands = np.empty((len(single), nrows, ncols))
+    bands.fill(np.nan)
+    for k, (ii, ((L, R, T, B), (TT, TB), (BT, BB), s)) in enumerate(single):
+        bands[k, :TB-TT, :R-L] = image[TT:TB, L:R]
+        bands[k, TB-TT:(TB-TT)+(BB-BT), :R-L] = image[BT:BB, L:R]
+    bg = centroid.nanrobomad(bands, sigma, axis=1)[0]
+    
+    # Subtract each window's column backgrounds
+    for k, (ii, ((L, R, T, B), tb, bb, s)) in enumerate(single):
+        (x, y) = windows[ii][:2]
+        window = np.array(image[T:B, L:R])
+        window[...] = window - bg[k, :R-L]
+        if neg is False:  window[(window < 0).nonzero()] = 0
+        results[ii] = (window, (L, T), (x - L, y - T))
+    
+    return results
     
     
 # ---------------- Dark Column Subtraction (OBSOLETE) ------------------
@@ -203,46 +316,15 @@ def darkcolsub(imgArray):
             DCstart = 16          # columns of dark rows start
             DCend = DCstart+2560  # columns of dark rows end
             
-            # get top dark row column averages
-            DRCTavgs = np.ones((1,DCend-DCstart), dtype=np.uint16)
-            temp = np.ones((1,16),dtype=np.uint16)
-
-            i = 0
-            for col in xrange(DCstart,DCend):
-                j = 0
-                for row in xrange(DRTstart,DRTend):
-                    temp[0][j] = imgArray[row][col]
-                    j = j+1
-                DRCTavgs[0][i] = int(np.average(temp))
-                i = i+1
-
-            # get bottom dark row column averages
-            DRCBavgs = np.ones((1,DCend-DCstart), dtype=np.uint16)
+            # get top and bottom dark row column averages (truncated to integers)
+            DRCTavgs = np.uint16(np.average(imgArray[DRTstart:DRTend, DCstart:DCend], axis=0))
+            DRCBavgs = np.uint16(np.average(imgArray[DRBstart:DRBend, DCstart:DCend], axis=0))
 
-            i = 0
-            for col in xrange(DCstart,DCend):
-                j = 0
-                for row in xrange(DRBstart,DRBend):
-                    temp[0][j] = imgArray[row][col]
-                    j = j+1
-                DRCBavgs[0][i] = int(np.average(temp))
-                i = i+1
-
-            # subtract for columns of top image area
-            i = 0
-            for col in xrange(DCstart,DCend):
-                for row in xrange(imgTstart,imgTend):
-                    newval = imgArray[row][col] - DRCTavgs[0][i]
-                    imgArray[row][col] = newval
-                i = i+1
-
-            # subtract for columns of bottom image area
-            i = 0
-            for col in xrange(DCstart,DCend):
-                for row in xrange(imgBstart,imgBend):
-                    newval = imgArray[row][col] - DRCBavgs[0][i]
-                    imgArray[row][col] = newval
-                i = i+1
+            # subtract for columns of top and bottom image areas, in place
+            top = imgArray[imgTstart:imgTend, DCstart:DCend]
+            bott = imgArray[imgBstart:imgBend, DCstart:DCend]
+            subtract_uint16(top, DRCTavgs, out=top)
+            subtract_uint16(bott, DRCBavgs, out=bott)
             
             # return subtracted image
             return imgArray
@@ -271,62 +353,25 @@ def colsigsub(imgArray):
             
             sigmult = 2 # 2 sigma
             
-            # allocate arrays 
-            topAvgs = np.ones((1,2560),dtype=np.uint16)
-            bottAvgs = np.ones((1,2560),dtype=np.uint16)
-
             # top and bottom column average in simga range
             print 'getting sigma averages...'
-            for col in range(Cstart,Cend):
-                
-                print 'getting col', col, 'mean and std...'
-                
-                topcol = imgArray[TRstart:TRend][:,col:col+1]
-                bottcol = imgArray[BRstart:BRend][:,col:col+1]
-                
-                topmean = int(np.average(topcol))
-                bottmean = int(np.average(bottcol))
-                topstd = int(np.std(topcol))
-                bottstd = int(np.std(bottcol))
-                
-                # if in sigma range, add to array
-                topsum = 0
-                bottsum = 0
-                topcount = 0
-                bottcount = 0
-                
-                print 'getting col', col, 'mean in', sigmult, 'sigma range...'
-                
-                for row in range(0,1080): 
-                    if topcol[row][0] in range(topmean-sigmult*topstd, topmean+sigmult*topstd+1):
-                        topsum = topsum + int(topcol[row][0])
-                        topcount = topcount + 1
-                    if bottcol[row][0] in range(bottmean-sigmult*bottstd, bottmean+sigmult*bottstd+1):
-                        bottsum = bottsum + int(bottcol[row][0])
-                        bottcount = bottcount + 1
-
-                # average applicable values
-                topAvgs[0][col] = topsum/topcount
-                bottAvgs[0][col] = bottsum/bottcount
+            def sigavgs(rows):
+                '''Integer average of each column, over the values within sigmult
+                (integer) standard deviations of the (integer) column mean.'''
+                mean = np.int_(np.average(rows, axis=0))
+                std = np.int_(np.std(rows, axis=0))
+                good = (rows >= mean - sigmult*std) & (rows <= mean + sigmult*std)
+                return np.uint16(np.where(good, rows, 0).sum(axis=0) / good.sum(axis=0))
             
-            # subtract for columns of top image area
-            print 'subtracting averages...'
-            def subtract_uint16(a, b):
-                '''Subtraction to avoid overflow problems and negatives. If the difference a-b 
-                is less than 0 it is assigned the value 0.'''
-                A = int(a) # signed int32
-                B = int(b) # signed int32
-                if A-B < 0:
-                    return (np.uint16(0)) # return 0
-
-                else:
-                    return (a-b)
+            top = imgArray[TRstart:TRend, Cstart:Cend]
+            bott = imgArray[BRstart:BRend, Cstart:Cend]
+            topAvgs = sigavgs(top)
+            bottAvgs = sigavgs(bott)
             
-            for col in xrange(Cstart,Cend):
-                for row in xrange(TRstart,TRend):
-                    imgArray[row][col] = subtract_uint16(imgArray[row][col], topAvgs[0][col])
-                for row in xrange(BRstart,BRend):
-                    imgArray[row][col] = subtract_uint16(imgArray[row][col], bottAvgs[0][col])
+            # subtract for columns of top and bottom image areas
+            print 'subtracting averages...'
+            subtract_uint16(top, topAvgs, out=top)
+            subtract_uint16(bott, bottAvgs, out=bott)
             
             # return subtracted image
             return imgArray
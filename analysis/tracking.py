@@ -11,8 +11,9 @@ __author__ = 'zachdischner'
 import numpy as np
 from numpy import linalg
 import transformations as transform
+import spectral as spectral
 import scipy as sp
-from scipy import signal,polyfit,polyval
+from scipy import signal,polyfit
 from scipy.signal import filter_design as fd
 from numpy.linalg import eig
 import matplotlib
@@ -20,8 +21,9 @@ import pylab as pylab
 import math
 import sys
 import time
+import multiprocessing
 
-def FindVariance(quaternions,delta_t=0.1,motion_frequency=3,plot=False,filt_type='ellip',method='kevin',attitude='azelbore'):
+def FindVariance(quaternions,delta_t=0.1,motion_frequency=3,plot=False,filt_type='ellip',method='kevin',attitude='azelbore',zero_phase=False):
     '''
     Purpose: Find the variance of a set of quaternions. Low Frequency components 
     are assumed to be invalid and will be discarded. Intended for analyzing
@@ -39,6 +41,7 @@ def FindVariance(quaternions,delta_t=0.1,motion_frequency=3,plot=False,filt_type
             {filt_type} - (optional) Specify filter type. Either:
                     * 'ellip' - try a scipy elliptical filter
                     * 'brick' - try a simple brick wall filter
+            zero_phase - (optional) Filter forward and backward, see high_pass()
                     
     Outputs: var - The computed variance of all observations. Meant to be some 
                    indication of DayStar performance
@@ -49,71 +52,12 @@ def FindVariance(quaternions,delta_t=0.1,motion_frequency=3,plot=False,filt_type
     '4' will cutoff (1/4) of the frequency spectrum.
     '''
     
-    # Hey, do this later smarter
-    quats=[]
-    qtmp=quaternions[0]
+    quats,angles,variables = attitude_angles(quaternions,method=method,attitude=attitude)
     
-    for q in quaternions:
-        # Get rotation from epoch by multiplying each quaternion by the sum
-        # of all previous quaternions
-        qtmp=transform.quaternion_multiply(qtmp,q)     
-        
-        if method == 'kevin':
-            quats.append(np.array(np.hstack([qtmp[3],qtmp[0:3]])))
-        else:
-            quats.append(np.array(np.hstack([qtmp[0:3],qtmp[3]])))
-
-    if attitude == 'azelbore':
-        # 3D frame unit vectors
-        x = np.array([1, 0, 0])
-        y = np.array([0, 1, 0])
-        z = np.array([0, 0, 1])
-        
-        Y = []
-        P = []
-        R = []
-        
-        for q in quats:
-            # Find rotation matrix from quaternion:
-            M = quat2dcm(q)
-            
-            # Rotate the x and y axes of the 3D frame
-            xhat = np.dot(M,x)
-            yhat = np.dot(M,y)
-            
-            # Find azimuth and elevation:
-            az = np.arctan2(xhat[1], xhat[0])
-            el = np.arcsin(xhat[2])
-            
-            # Find unrotated boresite y-axis:
-            yhatp = np.array([-np.sin(az), np.cos(az), 0])
-            
-            # Find the boresight rotation:
-            phi = np.arccos(np.dot(yhat,yhatp))
-            if yhat[2] < 0:
-                phi = -phi
-            
-            # Store data
-            Y.append(az)
-            P.append(-el)
-            R.append(phi)
-            
-        y_filt = high_pass(Y,  cutoff=motion_frequency, delta=delta_t, plot=plot,
-                           variable='Yaw', filt_type=filt_type, color='blue') #radians
-        p_filt = high_pass(P,  cutoff=motion_frequency, delta=delta_t, plot=plot,
-                           variable='Pitch', filt_type=filt_type, color='purple') #radians
-        r_filt = high_pass(R, cutoff=motion_frequency, delta=delta_t, plot=plot,
-                           variable='Roll', filt_type=filt_type, color='green') #radians
-            
-    else:
-        [Y,P,R]=quat2ypr(quats,method=method)
-    
-        y_filt = high_pass(Y,cutoff=motion_frequency,delta=delta_t,plot=plot,
-                           variable='yaw',filt_type=filt_type,color='blue') #radians
-        p_filt = high_pass(P,cutoff=motion_frequency,delta=delta_t,plot=plot,
-                           variable='pitch',filt_type=filt_type,color='purple') #radians
-        r_filt = high_pass(R,cutoff=motion_frequency,delta=delta_t,plot=plot,
-                           variable='roll',filt_type=filt_type,color='green') #radians
+    # Filter yaw, pitch and roll together
+    [y_filt,p_filt,r_filt] = high_pass(angles,cutoff=motion_frequency,delta=delta_t,plot=plot,
+                                       variable=variables,filt_type=filt_type,color=['blue','purple','green'],
+                                       zero_phase=zero_phase) #radians
 
 
     # Project filtered results on 2d plane:
@@ -134,25 +78,338 @@ def FindVariance(quaternions,delta_t=0.1,motion_frequency=3,plot=False,filt_type
 
     return y_var,p_var,r_var,y_filt,p_filt,r_filt
 
+def attitude_angles(quaternions,method='kevin',attitude='azelbore'):
+    '''
+    Purpose: The attitude angles FindVariance() filters, for a set of frame to frame quaternions.
+    
+    Inputs: quaternions - List of quaternion arrays, or an (N,4) array
+            method, attitude - (optional) as in FindVariance()
+    
+    Outputs: quats - (N,4) rotations from epoch, in the order method uses
+             angles - (3,N) array of yaw, pitch and roll [radians]
+             variables - names of the three angles, for plots
+    '''
+    # Get rotation from epoch by multiplying each quaternion by the product
+    # of all previous quaternions, as an (N,4) array
+    quats,angles,variables = epoch_angles(chain_quaternions(quaternions),method=method,attitude=attitude)
+    
+    return quats,angles,variables
+
+def epoch_angles(chained,method='kevin',attitude='azelbore'):
+    '''
+    Purpose: attitude_angles() of rotations from epoch, (N,4) quaternions [x,y,z,w] from
+             chain_quaternions().
+    '''
+    quats = chained
+    if method == 'kevin':
+        quats = np.roll(quats,1,axis=1)     # [w,x,y,z]
+
+    if attitude == 'azelbore':
+        [Y,P,R] = quat2azelbore(quats)
+        P = -P
+        variables = ['Yaw','Pitch','Roll']
+    else:
+        [Y,P,R]=quat2ypr(quats,method=method)
+        variables = ['yaw','pitch','roll']
+    
+    return quats,np.vstack([Y,P,R]),variables
+
+def variance_sweep(bursts,motion_frequencies,delta_t=0.1,filt_type='ellip',method='kevin',attitude='azelbore',
+                   zero_phase=False,processes=None):
+    '''
+    Purpose: FindVariance() yaw, pitch and roll variances for many motion frequencies, and 
+             optionally many bursts, without plots.
+    
+    Inputs: bursts - quaternions of one burst (as for FindVariance), or a dictionary
+                     {burst_num: quaternions} of several
+            motion_frequencies - cutoff frequencies to try [Hz]
+            delta_t, filt_type, method, attitude, zero_phase - (optional) as in FindVariance()
+            processes - (optional) number of worker processes for the 'ellip' filters. 
+                        None filters in this process.
+    
+    Outputs: table - structured array with one row per burst and motion frequency, and
+                     fields 'burst', 'motion_frequency', 'yaw', 'pitch' and 'roll'. The 
+                     variances are in arcseconds^2. A single burst is burst 0.
+                     
+    The attitude angles of each burst are found once. With filt_type='brick' every
+    variance then comes from one cumulative power spectrum (Parseval), so thousands of 
+    cutoffs cost about one FFT. Other filters are run once per cutoff, across the pool.
+    
+        >>> table = tracking.variance_sweep(quats,np.arange(0.1,5,0.01),filt_type='brick')
+        >>> best = table[np.argmin(table['yaw'] + table['pitch'] + table['roll'])]
+    '''
+    if not isinstance(bursts,dict):
+        bursts = {0: bursts}
+    motion_frequencies = np.atleast_1d(np.array(motion_frequencies,dtype=np.float64))
+    
+    # Attitude angles, once per burst
+    angles = [(burst_num,attitude_angles(bursts[burst_num],method=method,attitude=attitude)[1])
+              for burst_num in sorted(bursts)]
+    
+    # Standard deviations, (cutoffs,3) per burst
+    if filt_type.lower() == 'brick':
+        stds = [_brick_stds(a,motion_frequencies,delta_t) for (burst_num,a) in angles]
+    else:
+        # Chunks of cutoffs, a few per process
+        nchunks = 1 if processes is None else 4*processes
+        tasks = [(a,cutoffs,delta_t,filt_type,zero_phase) for (burst_num,a) in angles
+                 for cutoffs in np.array_split(motion_frequencies,min(nchunks,len(motion_frequencies)))]
+        if processes is None:
+            results = map(_filter_stds,tasks)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_filter_stds,tasks)
+            finally:
+                pool.close()
+        results = iter(results)
+        nchunks = len(tasks)/len(angles)
+        stds = [np.vstack([results.next() for ii in range(nchunks)]) for a in angles]
+    
+    # Table of variances [arcseconds^2]
+    table = np.zeros(len(angles)*len(motion_frequencies),dtype=[('burst',np.int64),('motion_frequency',np.float64),
+                                                                  ('yaw',np.float64),('pitch',np.float64),('roll',np.float64)])
+    for (ii,((burst_num,a),std)) in enumerate(zip(angles,stds)):
+        rows = table[ii*len(motion_frequencies):(ii+1)*len(motion_frequencies)]
+        rows['burst'] = burst_num
+        rows['motion_frequency'] = motion_frequencies
+        var = (3600*(std*180/math.pi))**2
+        rows['yaw'] = var[:,0]
+        rows['pitch'] = var[:,1]
+        rows['roll'] = var[:,2]
+    
+    return table
+
+def _filter_stds((angles,cutoffs,delta,filt_type,zero_phase)):
+    '''
+    Standard deviations (cutoffs,3) of the high_pass() filtered angles, for variance_sweep().
+    '''
+    return np.array([np.std(high_pass(angles,cutoff=cutoff,delta=delta,filt_type=filt_type,
+                                      zero_phase=zero_phase,verbose=False),axis=-1) for cutoff in cutoffs]).reshape(-1,3)
+
+def _brick_stds(angles,cutoffs,delta):
+    '''
+    Standard deviations (cutoffs,3) of the brick wall high_pass() of the angles, for 
+    variance_sweep(), from the power left above each cutoff.
+    '''
+    ns = angles.shape[-1]
+    fft_series = np.fft.rfft(angles)
+    nf = fft_series.shape[-1]
+    
+    # Power of each frequency in the series (Parseval); irfft drops the imaginary
+    # parts of the zero and Nyquist frequencies
+    weights = np.full(nf,2.)
+    weights[0] = 1
+    power = abs(fft_series)**2
+    power[:,0] = fft_series[:,0].real**2
+    if ns % 2 == 0:
+        weights[-1] = 1
+        power[:,-1] = fft_series[:,-1].real**2
+    power *= weights
+    
+    # Power from each frequency up, with zero past the end
+    above = np.zeros((angles.shape[0],nf + 1))
+    above[:,:nf] = np.cumsum(power[:,::-1],axis=1)[:,::-1]
+    
+    # brick_wall() keeps the frequencies above cutoff_freq and sets an exact match to 0.5
+    cutoff_freq = np.maximum(cutoffs*(ns*delta),0)
+    first = np.minimum(np.floor(cutoff_freq).astype(np.int64) + 1,nf)
+    exact = (cutoff_freq == np.floor(cutoff_freq)) & (cutoff_freq < nf)
+    edge = np.where(exact,0.25*weights[np.minimum(cutoff_freq,nf - 1).astype(np.int64)],0)
+    mean = np.where(exact & (cutoff_freq == 0),0.5/ns,0)
+    var = (above[:,first] + edge)/ns**2 - mean**2
+    std_filt = np.sqrt(np.maximum(var,0))
+    
+    # high_pass() takes a linear fit instead when that does better
+    t = np.arange(0,ns)
+    (ar,br) = polyfit(t,angles.T,1)
+    std_lin = np.std((np.multiply.outer(ar,t) + br[:,np.newaxis]) - angles,axis=-1)
+    
+    return np.minimum(std_filt,std_lin[:,np.newaxis]).T
+
+class JitterMonitor(object):
+    """
+        Purpose: FindVariance() while the quaternions are still coming in. Quaternions are
+        added one at a time or in chunks; each chunk is chained onto the previous ones,
+        turned into yaw, pitch and roll and high pass filtered with the filter state kept
+        between chunks (sosfilt with zi). The filtered angles are the ones high_pass()
+        gives the whole series, up to rounding.
+
+        It keeps the running mean and variance of the filtered angles (Welford's method)
+        and the last "window" filtered samples for a moving standard deviation, like the
+        "Moving STD" plot of high_pass(). Memory doesn't grow with the series.
+
+        Only the elliptic filter runs in a stream: there is no brick wall or linear fit
+        fallback, and a cutoff that can't be designed raises ValueError.
+
+        Example:
+            >>> monitor = tracking.JitterMonitor(delta_t=0.1, motion_frequency=3.5)
+            >>> for chunk in quaternion_chunks:
+            ...     monitor.update(chunk)
+            ...     print monitor.variances(), monitor.moving_std()
+    """
+    def __init__(self, delta_t=0.1, motion_frequency=3, method='kevin', attitude='azelbore', window=16):
+        self.delta_t = delta_t
+        self.motion_frequency = motion_frequency
+        self.method = method
+        self.attitude = attitude
+        self.window = window
+        self.sos = highpass_design(motion_frequency, delta_t)
+        self.reset()
+
+    def reset(self):
+        """
+            Purpose: Start over, as if no quaternions had been added.
+        """
+        self.count = 0
+        self._last = None
+        self._zi = np.zeros((self.sos.shape[0], 3, 2))
+        self._mean = np.zeros(3)
+        self._M2 = np.zeros(3)
+        self._recent = np.zeros((3, self.window))
+
+    def update(self, quaternions):
+        """
+            Purpose: Add a quaternion [x,y,z,w], or a chunk of them, in order.
+
+            Outputs: The (3,N) filtered yaw, pitch and roll of the chunk [radians]
+        """
+        q = np.reshape(np.array(quaternions, dtype=np.float64), (-1, 4))
+        if len(q) == 0:
+            return np.zeros((3, 0))
+
+        # Rotations from epoch, carrying on from the last chunk
+        chained = chain_quaternions(q, initial=self._last)
+        self._last = chained[-1]
+        angles = epoch_angles(chained, method=self.method, attitude=self.attitude)[1]
+
+        # High pass, carrying the filter state
+        (filtered, self._zi) = signal.sosfilt(self.sos, angles, axis=-1, zi=self._zi)
+
+        # Merge the chunk's mean and variance into the running ones
+        n = filtered.shape[1]
+        mean = filtered.mean(axis=1)
+        M2 = ((filtered - mean[:, np.newaxis])**2).sum(axis=1)
+        total = self.count + n
+        delta = mean - self._mean
+        self._mean += delta*n/total
+        self._M2 += M2 + delta**2*self.count*n/total
+        self.count = total
+
+        # Keep the last window samples
+        keep = min(n, self.window)
+        self._recent = np.roll(self._recent, -keep, axis=1)
+        self._recent[:, -keep:] = filtered[:, -keep:]
+
+        return filtered
+
+    def std(self):
+        """
+            Purpose: Standard deviations of the filtered yaw, pitch and roll so far [radians].
+        """
+        return np.sqrt(self._M2/max(self.count, 1))
+
+    def rms(self):
+        """
+            Purpose: RMS of the filtered yaw, pitch and roll so far [radians].
+        """
+        return np.sqrt(self._M2/max(self.count, 1) + self._mean**2)
+
+    def variances(self):
+        """
+            Purpose: Yaw, pitch and roll variances so far [arcseconds^2], as FindVariance() 
+            gives them.
+        """
+        (y_var, p_var, r_var) = (3600*(self.std()*180/math.pi))**2
+        return y_var, p_var, r_var
+
+    def moving_std(self):
+        """
+            Purpose: Standard deviations of the last "window" filtered yaw, pitch and roll 
+            [radians] (of all of them, before there are that many).
+        """
+        recent = self._recent[:, self.window - min(self.count, self.window):]
+        if recent.shape[1] == 0:
+            return np.zeros(3)
+        return np.std(recent, axis=1)
+
+def chain_quaternions(quaternions,initial=None):
+    '''
+    Purpose: Rotations from epoch of a sequence of frame to frame quaternions [x,y,z,w].
+    
+    Inputs: quaternions - list of quaternion arrays, or an (N,4) array
+            initial - (optional) rotation the products start from, e.g. the last one of
+                      the previous chunk of a sequence. By default the first quaternion.
+    
+    Outputs: (N,4) array of the running products initial*q0*q1*...*qk. By default the
+             first quaternion is applied twice, as it always has been here.
+             
+    The running products are a prefix scan: each pass multiplies every product by the 
+    one "step" places before it and doubles the step, so there are log2(N) array passes
+    instead of N quaternion products.
+    '''
+    q = np.reshape(np.array(quaternions,dtype=np.float64),(-1,4))
+    if initial is None:
+        initial = q[:1]
+    chained = np.concatenate([np.reshape(initial,(-1,4)),q])
+    
+    step = 1
+    while step < len(chained):
+        chained[step:] = quat_multiply(chained[:-step],chained[step:])
+        step *= 2
+    
+    return chained[1:]
+
+def quat_multiply(q1,q0):
+    '''
+    transformations.quaternion_multiply() for arrays of quaternions [x,y,z,w], (...,4).
+    '''
+    x0,y0,z0,w0 = (q0[...,0],q0[...,1],q0[...,2],q0[...,3])
+    x1,y1,z1,w1 = (q1[...,0],q1[...,1],q1[...,2],q1[...,3])
+    q = np.empty(np.broadcast(x0,x1).shape + (4,))
+    q[...,0] = x1*w0 + y1*z0 - z1*y0 + w1*x0
+    q[...,1] = -x1*z0 + y1*w0 + z1*x0 + w1*y0
+    q[...,2] = x1*y0 - y1*x0 + z1*w0 + w1*z0
+    q[...,3] = -x1*x0 - y1*y0 - z1*z0 + w1*w0
+    return q
+
+def quat2azelbore(quats):
+    '''
+    Purpose: Azimuth, elevation and boresight rotation of every quaternion of an (N,4) 
+             array, in the order quat2dcm() takes.
+    
+    Outputs: az,el,phi - arrays of angles [radians]
+    '''
+    # Rotated x and y axes of the 3D frame, the first two columns of the rotation matrices
+    M = quat2dcm(quats)
+    xhat = M[...,:,0]
+    yhat = M[...,:,1]
+    
+    # Find azimuth and elevation:
+    az = np.arctan2(xhat[...,1], xhat[...,0])
+    el = np.arcsin(xhat[...,2])
+    
+    # Find the boresight rotation from the unrotated boresight y-axis, [-sin(az),cos(az),0]:
+    # the angle between them from its cosine (dot) and sine (cross), which keeps small
+    # rolls precise where arccos alone doesn't
+    (s,c) = (np.sin(az),np.cos(az))
+    cosphi = -s*yhat[...,0] + c*yhat[...,1]
+    sinphi = np.hypot(yhat[...,2], c*yhat[...,0] + s*yhat[...,1])
+    phi = np.arctan2(sinphi, cosphi)
+    phi = np.where(yhat[...,2] < 0, -phi, phi)
+    
+    return az,el,phi
 
 def project2d(y,p,r):
     '''
     Project yaw, ptich and roll values back into the 2D image frame.
     '''
 
-    # Convert y,p,r to transformation matrix:
-    T = map(euler3212dcm,y,p,r)
+    # Rotate unit x-vector by the y,p,r transformation matrices:
+    X = euler3212dcm(np.asarray(y),np.asarray(p),np.asarray(r))[...,:,0]
     
-    # Rotate unit x-vector
-    z = np.array([1,0,0])
-    X = []
-    for t in T:
-        X.append(np.dot(t,z))
-    
-    # Reconfigure the array:
-    X = zip(*X)
-    y = -np.array(X[1])*3600*180/np.pi
-    z = -np.array(X[2])*3600*180/np.pi
+    y = -X[...,1]*3600*180/np.pi
+    z = -X[...,2]*3600*180/np.pi
     
     # Get standard deviation:
     d = np.sqrt(np.sum((y**2 + z**2)/len(y)))
@@ -182,19 +439,11 @@ def project2dquat(q):
     Project yaw, ptich and roll values back into the 2D image frame.
     '''
 
-    # Convert y,p,r to transformation matrix:
-    T = map(quat2dcm,q)
-    
-    # Rotate unit x-vector
-    z = np.array([1,0,0])
-    X = []
-    for t in T:
-        X.append(np.dot(t,z))
+    # Rotate unit x-vector by the quaternion transformation matrices:
+    X = quat2dcm(q)[...,:,0]
     
-    # Reconfigure the array:
-    X = zip(*X)
-    y = -np.array(X[1])*3600*180/np.pi
-    z = -np.array(X[2])*3600*180/np.pi
+    y = -X[...,1]*3600*180/np.pi
+    z = -X[...,2]*3600*180/np.pi
     
     # Get standard deviation:
     d = np.sqrt(np.sum((y**2 + z**2)/len(y)))
@@ -209,11 +458,63 @@ def project2dquat(q):
     pylab.ylabel('Y (arcseconds)')
     pylab.grid(True)
     
-def high_pass(series,cutoff=100,delta=1,plot=False,filt_type='ellip',variable='signal',color='blue'):
+# Second-order sections of high pass designs, keyed by (cutoff,delta,Rp,As,filt_type)
+_highpass_designs = {}
+
+def highpass_design(cutoff,delta=1,Rp=0.01,As=90,filt_type='ellip'):
     """
-        Purpose: High-pass filter a single array series using fourrier transforms.
+        Purpose: Design (once) the IIR high pass filter used by high_pass(), in second-order
+                 sections form. The (b,a) form of a 90 dB elliptic design loses precision
+                 easily; sections don't.
 
-        Inputs: {series} -an array of observations to filter (i.e) lots of angle measurements
+        Inputs: {cutoff} -cutoff (passband edge) frequency [Hz]
+                {delta}  -(optional) time between observations [s]
+                {Rp}     -(optional) passband maximum loss [dB] (gpass)
+                {As}     -(optional) stopband minimum attenuation [dB] (gstop)
+                {filt_type} -(optional) scipy iirdesign ftype, 'ellip' by default
+
+        Outputs:{sos} -the (n,6) array of sections. Designs are cached, don't modify it.
+        
+        Raises ValueError when the design isn't possible, i.e. the cutoff is not between
+        0 and the Nyquist frequency.
+    """
+    key = (cutoff,delta,Rp,As,filt_type)
+    if key not in _highpass_designs:
+        Nyquist_freq  = 1./delta/2   # Nyquist frequency. Highest freq we can detect
+        Wp = cutoff/Nyquist_freq     # Proportion of Full spectrum to filter
+        if not 0 < Wp < 1:
+            raise ValueError("Cutoff frequency %s Hz is not between 0 and the Nyquist frequency, %s Hz" % (cutoff,Nyquist_freq))
+        Ws = Wp-0.1*Wp               # Stop frequency
+        
+        sos = fd.iirdesign(Wp, Ws, Rp, As, ftype=filt_type, output='sos')
+        if not np.all(np.isfinite(sos)):
+            raise ValueError("Filter design for a %s Hz cutoff is not finite" % cutoff)
+        _highpass_designs[key] = sos
+        
+    return _highpass_designs[key]
+
+def brick_wall(series,cutoff_freq):
+    """
+        Purpose: Dumb brick wall high pass of the last axis of series, in the frequency domain.
+        
+        Inputs: {series} -an array of observations, or a stack of them
+                {cutoff_freq} -index of the cutoff frequency (cutoff*ns*delta). Lower
+                               frequencies are zeroed and an exact match is set to 0.5.
+    """
+    fft_filt = np.fft.rfft(series)
+    fft_filt[...,:int(np.ceil(max(cutoff_freq,0)))] = 0.0
+    if cutoff_freq == int(cutoff_freq) and 0 <= cutoff_freq < fft_filt.shape[-1]:
+        fft_filt[...,int(cutoff_freq)] = 0.5
+    # Inverse fourrier. Get new filtered signal back, as long as the series
+    return np.fft.irfft(fft_filt,np.shape(series)[-1])
+
+def high_pass(series,cutoff=100,delta=1,plot=False,filt_type='ellip',variable='signal',color='blue',zero_phase=False,verbose=True):
+    """
+        Purpose: High-pass filter an array series, or a stack of them such as a (3,N) 
+                 yaw/pitch/roll array, using fourrier transforms.
+
+        Inputs: {series} -an array of observations to filter (i.e) lots of angle measurements,
+                          or a stack of series to filter along the last axis
                 {cutoff} -(optional)
                     *if 'brick' Specify cutoff frequency [HZ]
                     *if 'ellip' Specify fraction of frequency spectrum to lose. (cutoff > 1.1)
@@ -222,6 +523,10 @@ def high_pass(series,cutoff=100,delta=1,plot=False,filt_type='ellip',variable='s
                 {filt_type}  -(optional) Specify filter type. Either:
                         * 'ellip' - try a scipy elliptical filter
                         * 'brick' - try a simple brick wall filter
+                {variable},{color} -(optional) plot labels, one per series for a stack
+                {zero_phase} -(optional) run the elliptical filter forward and backward
+                              (sosfiltfilt), so it doesn't shift the series
+                {verbose} -(optional) print when falling back to other filters
 
         Outputs:{new_series} -the new series, with low frequency changes filtered out
 
@@ -233,162 +538,128 @@ def high_pass(series,cutoff=100,delta=1,plot=False,filt_type='ellip',variable='s
 
     ## Convert to Frequency Domain
     #---------------------------------------------------------
-    series  = np.array(series)          # Convert to Array
-    ns      =len(series)                # number of samples
+    series  = np.array(series,dtype=np.float64)     # Convert to Array
+    ns      = series.shape[-1]                      # number of samples
     cutoff_freq=cutoff*(ns*delta)       # Index of cutoff frequency in this new awesome frequency domain
     #---------------------------------------------------------
 
-    ## Construct Frequency Filter
-    #---------------------------------------------------------
-    Nyquist_freq  = 1/delta/2   # Nyquist frequency. Highest freq we can detect
-    Wp = cutoff/Nyquist_freq   # Proportion of Full spectrum to filter
-    if Wp > 1:
-        print "Hey douche, your cutoff frequency is higher than your Nyquist frequency."
-        print "You can't filter this way"
-#    Wp = cutoff_freq/(ns/math.pi) #(ns*delta)/cutoff_freq     # Cutoff frequency, normalized to 1
-    Ws = Wp-0.1*Wp                  # Stop frequency
-    Rp = 0.01                       # passband maximum loss (gpass)
-    As = 90                         # stoppand min attenuation (gstop)
-
     if filt_type.lower() == 'ellip':
         try:
-            # Must 'try' this because wrong cutoff can spawn an error really easily
-            b,a = fd.iirdesign(Wp, Ws, Rp, As, ftype='ellip')
-            new_series = signal.lfilter(b,a,series)
-        except:
-            print "Something went wrong with the Fourier Filter, possibly the cutoff frequency wrong"
-            print "Cutoff freq is : %s" % cutoff_freq
-            print "Just doing a dumb brick wall filter"
-#            cutoff_freq=(ns/cutoff*delta)
-            fft_series = np.fft.rfft(series)
-            fft_filt   = np.array(fft_series.copy())
-            for ii in range(0, len(fft_filt)):
-                if ii == cutoff_freq:
-                    fft_filt[ii] = 0.5
-                if ii <cutoff_freq:
-                    fft_filt[ii] = 0.0
-            # Inverse fourrier. Get new filtered signal back
-            new_series = np.array(np.fft.irfft(fft_filt))   #                fft_filt[len(fft_filt) - ii -1] = 0.0
-    elif filt_type.lower() == 'brick':
-        fft_series = np.fft.rfft(series)
-        fft_filt   = np.array(fft_series.copy())
-        for ii in range(0, len(fft_filt)):
-            if ii == cutoff_freq:
-                fft_filt[ii] = 0.5
-            if ii <cutoff_freq:
-                fft_filt[ii] = 0.0
-            # Inverse fourrier. Get new filtered signal back
-        new_series = np.array(np.fft.irfft(fft_filt))
+            # Wrong cutoffs can't be designed
+            sos = highpass_design(cutoff,delta)
+            if zero_phase:
+                new_series = signal.sosfiltfilt(sos,series,axis=-1)
+            else:
+                new_series = signal.sosfilt(sos,series,axis=-1)
+        except (ValueError,ArithmeticError,linalg.LinAlgError) as e:
+            if verbose:
+                print "Something went wrong with the Fourier Filter, possibly the cutoff frequency wrong"
+                print "%s: %s" % (type(e).__name__,e)
+                print "Cutoff freq is : %s" % cutoff_freq
+                print "Just doing a dumb brick wall filter"
+            new_series = brick_wall(series,cutoff_freq)
     else:
-        fft_series = np.fft.rfft(series)
-        fft_filt   = np.array(fft_series.copy())
-        for ii in range(0, len(fft_filt)):
-            if ii == cutoff_freq:
-                fft_filt[ii] = 0.5
-            if ii <cutoff_freq:
-                fft_filt[ii] = 0.0
-            # Inverse fourrier. Get new filtered signal back
-        new_series = np.array(np.fft.irfft(fft_filt))
+        new_series = brick_wall(series,cutoff_freq)
 
     # Try a linear regression. See which is better
-    (ar,br)=polyfit(np.arange(0,len(series)),series,1)
-    lin_series=polyval([ar,br],np.arange(0,len(series))) - series
-    res_filt = np.std(new_series)
-    res_lin = np.std(lin_series)
-
-    if res_filt > res_lin:
-        if variable != 'signal':
-            print variable
-        print "Frequency filter is way worse than a simple linear one"
-        print "Freq filter gives resulting std of : %s " % res_filt
-        print "Linear regression gives resulting std of : %s " % res_lin
-        new_series = lin_series
+    t = np.arange(0,ns)
+    (ar,br) = polyfit(t,series.T,1)
+    lin_series = (np.multiply.outer(ar,t) + np.expand_dims(br,-1)) - series
+    res_filt = np.std(new_series,axis=-1)
+    res_lin = np.std(lin_series,axis=-1)
+
+    worse = res_filt > res_lin
+    labels = variable if series.ndim > 1 else [variable]
+    if verbose:
+        for ii in np.flatnonzero(worse):
+            if labels[ii] != 'signal':
+                print labels[ii]
+            print "Frequency filter is way worse than a simple linear one"
+            print "Freq filter gives resulting std of : %s " % np.atleast_1d(res_filt)[ii]
+            print "Linear regression gives resulting std of : %s " % np.atleast_1d(res_lin)[ii]
+    new_series = np.where(np.expand_dims(worse,-1),lin_series,new_series)
 
+    if plot:
+        if series.ndim == 1:
+            plot_high_pass(series,new_series,delta,variable,color)
+        else:
+            for ii in range(series.shape[0]):
+                plot_high_pass(series[ii],new_series[ii],delta,variable[ii],color[ii])
 
+    return new_series
 
-    if plot:
-        pylab.figure(num=None, figsize=(13, 7), dpi=80, facecolor='w', edgecolor='k')
-        # Signal
-        pylab.subplot(2,2,1)
-        pylab.plot(np.arange(0,len(series)*delta,delta)[0:len(series)],series*180/math.pi*3600,color=color)
+def plot_high_pass(series,new_series,delta,variable,color):
+    """
+        Purpose: Plots of a series filtered by high_pass(): the series and its power before
+                 and after, and the filtered motion with its moving standard deviation.
+    """
+    pylab.figure(num=None, figsize=(13, 7), dpi=80, facecolor='w', edgecolor='k')
+    # Signal
+    pylab.subplot(2,2,1)
+    pylab.plot(np.arange(0,len(series)*delta,delta)[0:len(series)],series*180/math.pi*3600,color=color)
 #        pylab.plot(series*180/math.pi*3600)
-        pylab.xlabel('Time')
-        pylab.ylabel(variable + " [arcseconds]")
+    pylab.xlabel('Time')
+    pylab.ylabel(variable + " [arcseconds]")
 
-        pylab.subplot(2,2,3)
+    pylab.subplot(2,2,3)
 #        pylab.plot(new_series*180/math.pi*3600)
-        pylab.plot(np.arange(0,len(new_series)*delta,delta)[0:len(new_series)],new_series*180/math.pi*3600,color=color)
-        pylab.xlabel('Time')
-        pylab.ylabel('Filtered ' + variable + " [arcseconds]")
-
-        #fourrier signal
-        pylab.subplot(2,2,2)
-#        pylab.plot(np.fft.rfft(series))
-        power_axis = np.fft.fftfreq(len(series),0.1)
-        power_axis=power_axis[power_axis>0]
-        power_axis=np.append(power_axis,1/delta/2)
-
-#        power_axis=sp.fftpack.rfftfreq(len(series),0.1)
-
-
-        pylab.plot(power_axis, power_spectrum(series,sampling_frequency=1/delta),color=color)
-        pylab.xlabel('Freq (Hz)')
-        pylab.ylabel('Original Power (log10 Scale)')
-
-        pylab.subplot(2,2,4)
-#        pylab.plot(power_axis,np.fft.rfft(new_series))
-#        pylab.plot(np.fft.rfft(new_series))
-        pylab.plot(power_axis,power_spectrum(new_series,sampling_frequency=1/delta),color=color)
-        pylab.xlabel('Freq (Hz)')
-        pylab.ylabel('Filtered Power (log10 Scale)')
-
-
-        # Motion and Correlated Standard Deviation
-        moving_width = 16   # Do even numbers
-        stdseries=np.zeros(len(series))
-        for ii in np.arange(moving_width/2,len(series)-moving_width/2):
-            stdseries[ii]=np.std(new_series[ii-moving_width/2:ii+moving_width/2])
-
-        pylab.figure(num=None, figsize=(13, 7), dpi=80, facecolor='w', edgecolor='k')
-        pylab.title('Gondola Motion and Corresponding Signal Standard Deviation')
-        pylab.subplot(2,1,1)
-        pylab.grid()
-        pylab.plot(np.arange(0,len(series)*delta,delta)[0:len(series)],series*180/math.pi*3600,color=color)
+    pylab.plot(np.arange(0,len(new_series)*delta,delta)[0:len(new_series)],new_series*180/math.pi*3600,color=color)
+    pylab.xlabel('Time')
+    pylab.ylabel('Filtered ' + variable + " [arcseconds]")
+
+    #fourrier signal, both power spectra at once
+    (power_axis,power) = power_spectrum(np.vstack([series,new_series]),sampling_frequency=1/delta)
+    pylab.subplot(2,2,2)
+    pylab.semilogy(power_axis,power[0],color=color)
+    pylab.xlabel('Freq (Hz)')
+    pylab.ylabel('Original PSD [rad^2/Hz]')
+
+    pylab.subplot(2,2,4)
+    pylab.semilogy(power_axis,power[1],color=color)
+    pylab.xlabel('Freq (Hz)')
+    pylab.ylabel('Filtered PSD [rad^2/Hz]')
+
+
+    # Motion and Correlated Standard Deviation
+    moving_width = 16   # Do even numbers
+    stdseries=np.zeros(len(series))
+    for ii in np.arange(moving_width/2,len(series)-moving_width/2):
+        stdseries[ii]=np.std(new_series[ii-moving_width/2:ii+moving_width/2])
+
+    pylab.figure(num=None, figsize=(13, 7), dpi=80, facecolor='w', edgecolor='k')
+    pylab.title('Gondola Motion and Corresponding Signal Standard Deviation')
+    pylab.subplot(2,1,1)
+    pylab.grid()
+    pylab.plot(np.arange(0,len(series)*delta,delta)[0:len(series)],series*180/math.pi*3600,color=color)
 #        pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],series*180/math.pi*3600 + 10*stdseries*180/math.pi*3600,color='red')
 #        pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],series*180/math.pi*3600-10*stdseries*180/math.pi*3600,color='red')
-        pylab.xlabel('Time')
-        pylab.ylabel(variable + " [arcseconds]")
+    pylab.xlabel('Time')
+    pylab.ylabel(variable + " [arcseconds]")
 
-        pylab.subplot(2,1,2)
-        pylab.grid()
-        pylab.plot(np.arange(0,len(new_series)*delta,delta)[0:len(new_series)],new_series*180/math.pi*3600,color=color)
+    pylab.subplot(2,1,2)
+    pylab.grid()
+    pylab.plot(np.arange(0,len(new_series)*delta,delta)[0:len(new_series)],new_series*180/math.pi*3600,color=color)
+
+    #3 Standard Deviation Envelope
+    pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],3*stdseries*180/math.pi*3600,color='red',linewidth=2)
+    pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],-3*stdseries*180/math.pi*3600,color='red',linewidth=2)
+    pylab.xlabel('Time')
+    pylab.ylabel(variable + " Moving STD [arcseconds]")
+    pylab.legend(['High Frequency Motion','+3 Sigma','-3 Sigma'])
 
-        #3 Standard Deviation Envelope
-        pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],3*stdseries*180/math.pi*3600,color='red',linewidth=2)
-        pylab.plot(np.arange(0,len(stdseries)*delta,delta)[0:len(stdseries)],-3*stdseries*180/math.pi*3600,color='red',linewidth=2)
-        pylab.xlabel('Time')
-        pylab.ylabel(variable + " Moving STD [arcseconds]")
-        pylab.legend(['High Frequency Motion','+3 Sigma','-3 Sigma'])
 
 
 
-    return new_series
 
 def optimize_variance(quats,delta_t=0.1):
     """
     Purpose: Very basic attempt to find best motion frequency to get the best variance for a single series observations
     """
-    ns = len(quats)
-    # Max cutoff leaves at least half of the spectrum
-    cutoff_freq=ns/2
-    cutoff2=cutoff_freq/(ns*delta_t)
-
     motion_freq=np.arange(0,5,0.1)
-    yv=np.zeros(len(motion_freq))
-    pv=np.zeros(len(motion_freq))
-    rv=np.zeros(len(motion_freq))
-    for ii in np.arange(0,len(motion_freq),1):
-        yv[ii],pv[ii],rv[ii],t,tt,ttt=FindVariance(quats,motion_frequency=motion_freq[ii],delta_t=0.1)
+    table = variance_sweep(quats,motion_freq,delta_t=delta_t)
+    yv = table['yaw']
+    pv = table['pitch']
+    rv = table['roll']
 
     pylab.figure()
     pylab.plot(motion_freq,yv)
@@ -479,14 +750,16 @@ def quat2ypr(quaternions,method='kevin'):
             >>>quats=tfdat /= abs(fdat).max()racking.sample_quats()
             >>>[r,p,y]=tracking.quat2rpy(quats)
     """
+    if method != 'transform':
+        # All at once
+        YPR = quat2euler321(np.reshape(np.array(quaternions,dtype=np.float64),(-1,4)))
+        return YPR[:,0],YPR[:,1],YPR[:,2]
+        
     roll=[]
     pitch=[]
     yaw=[]
     for q in quaternions:
-        if method is 'transform':
-            YPR=transform.euler_from_quaternion(q, axes='rzyx')   # default is 'sxyz'
-        else:
-            YPR= quat2euler321(q)
+        YPR=transform.euler_from_quaternion(q, axes='rzyx')   # default is 'sxyz'
         yaw.append(YPR[0])
         pitch.append(YPR[1])
         roll.append(YPR[2])
@@ -494,39 +767,69 @@ def quat2ypr(quaternions,method='kevin'):
 
 def quat2euler321(q):
     dcm = quat2dcm(q)
-    return np.array([math.atan2(dcm[0,1],dcm[0,0]), -math.asin(dcm[0,2]), math.atan2(dcm[1,2],dcm[2,2])])
+    return np.stack([np.arctan2(dcm[...,0,1],dcm[...,0,0]), -np.arcsin(dcm[...,0,2]), np.arctan2(dcm[...,1,2],dcm[...,2,2])],axis=-1)
     
 def quat2dcm(q):
-    return np.array([[q[0]**2+q[1]**2-q[2]**2-q[3]**2, 2*(q[1]*q[2]+q[0]*q[3]), 2*(q[1]*q[3]-q[0]*q[2])],
-                    [2*(q[1]*q[2]-q[0]*q[3]), q[0]**2-q[1]**2+q[2]**2-q[3]**2, 2*(q[2]*q[3]+q[0]*q[1])],
-                    [2*(q[1]*q[3]+q[0]*q[2]), 2*(q[2]*q[3]-q[0]*q[1]), q[0]**2-q[1]**2-q[2]**2+q[3]**2]]);
+    '''
+    Rotation matrix of a quaternion [w,x,y,z], or (...,3,3) matrices of a (...,4) array.
+    '''
+    q = np.asarray(q,dtype=np.float64)
+    q0,q1,q2,q3 = (q[...,0],q[...,1],q[...,2],q[...,3])
+    M = np.empty(q.shape[:-1] + (3,3))
+    M[...,0,:] = np.stack([q0**2+q1**2-q2**2-q3**2, 2*(q1*q2+q0*q3), 2*(q1*q3-q0*q2)],axis=-1)
+    M[...,1,:] = np.stack([2*(q1*q2-q0*q3), q0**2-q1**2+q2**2-q3**2, 2*(q2*q3+q0*q1)],axis=-1)
+    M[...,2,:] = np.stack([2*(q1*q3+q0*q2), 2*(q2*q3-q0*q1), q0**2-q1**2-q2**2+q3**2],axis=-1)
+    return M
                     
 def euler3212dcm(y,p,r):
+    '''
+    Rotation matrix of a 3-2-1 (yaw,pitch,roll) sequence, or (...,3,3) matrices of arrays.
+    '''
     cy = np.cos(y)
     cp = np.cos(p)
     cr = np.cos(r)
     sy = np.sin(y)
     sp = np.sin(p)
     sr = np.sin(r)
-    return np.array([[           cy*cp,            sy*cp,   -sp],
-                     [cy*sp*sr - sy*cr, sy*sp*sr + cy*cr, cp*sr],
-                     [cy*sp*cr + sy*sr, sy*sp*cr - cy*sr, cp*cr]]) 
+    M = np.empty(np.broadcast(cy,cp,cr).shape + (3,3))
+    M[...,0,:] = np.stack(np.broadcast_arrays(           cy*cp,            sy*cp,   -sp),axis=-1)
+    M[...,1,:] = np.stack(np.broadcast_arrays(cy*sp*sr - sy*cr, sy*sp*sr + cy*cr, cp*sr),axis=-1)
+    M[...,2,:] = np.stack(np.broadcast_arrays(cy*sp*cr + sy*sr, sy*sp*cr - cy*sr, cp*cr),axis=-1)
+    return M
 
-def power_spectrum(series,sampling_frequency=1):
+def power_spectrum(series,sampling_frequency=1,nperseg=256):
     """
-        Purpose: Compute power spectrum of a data series
-        Inputs: series-An array of data to compute the power spectrum for
-                sampling_frequency-(optional) IDK what for yet
-        Outputs: power-the computed power spectrum
+        Purpose: Compute the power spectrum of a data series, or of a (3,N) yaw/pitch/roll array
+        Inputs: series-An array of data to compute the power spectrum for (along its last axis)
+                sampling_frequency-(optional) samples per second [Hz], 1/delta
+                nperseg-(optional) samples per Welch segment, at most the series length
+        Outputs: freqs-the frequency axis [Hz]
+                 power-the Welch power spectral density [units^2/Hz], see spectral.welch()
     """
-    # Get sampling frequency
-    Fs = 1/sampling_frequency
+    series = np.asarray(series)
+    return spectral.welch(series,fs=sampling_frequency,nperseg=min(nperseg,series.shape[-1]))
 
-    freq=np.fft.rfft(series)
-    power=freq*np.conj(freq)
-#    power=power[range(len(power)/2)]
-#    power /= abs(power).max()        #Normalize to 1
-    return np.log10(power)
+def attitude_spectra(bursts,delta_t=0.1,nperseg=256,method='kevin',attitude='azelbore',dtype=np.float64):
+    """
+        Purpose: Power spectra of the yaw, pitch and roll of many bursts, to characterize the
+                 gondola motion of every burst of a night in one run.
+        Inputs: bursts-quaternions of one burst (as for FindVariance), or a dictionary 
+                       {burst_num: quaternions} of several
+                delta_t-(optional) time between quaternion observations [s]
+                nperseg-(optional) samples per Welch segment, at most the length of the
+                        shortest burst (every burst shares one frequency axis)
+                method,attitude-(optional) as in FindVariance()
+                dtype-(optional) np.float32 for big batches
+        Outputs: freqs-the frequency axis [Hz]
+                 psds-dictionary {burst_num: (3,nperseg/2+1) yaw/pitch/roll PSDs [rad^2/Hz]}
+                      A single burst is burst 0.
+    """
+    if not isinstance(bursts,dict):
+        bursts = {0: bursts}
+    angles = dict((burst_num,attitude_angles(bursts[burst_num],method=method,attitude=attitude)[1])
+                  for burst_num in bursts)
+    shortest = min(a.shape[-1] for a in angles.values())
+    return spectral.welch_bursts(angles,fs=1./delta_t,nperseg=min(nperseg,shortest),dtype=dtype)
 
 
 
@@ -541,7 +844,7 @@ def plot_power(series,sampling_frequency=1):
     """
         Purpose: Illustrate the power spectrum calculation for a given data series
         Inputs: series-A data array to show the power spectrum for. Calls power_spectrum
-                sampling_frequency-(optional) IDK what for yet
+                sampling_frequency-(optional) samples per second [Hz]
         Outputs: none
     """
     t=sp.arange(0,len(series))/(1.0*sampling_frequency)
@@ -551,10 +854,10 @@ def plot_power(series,sampling_frequency=1):
     pylab.ylabel('Amplitude')
     pylab.subplot(2,1,2)
 
-    power=power_spectrum(series)
-    pylab.plot(power)
+    (freqs,power)=power_spectrum(series,sampling_frequency=sampling_frequency)
+    pylab.semilogy(freqs,power)
     pylab.xlabel('Freq (Hz)')
-    pylab.ylabel('Power')
+    pylab.ylabel('Power (PSD)')
 
 
 
@@ -563,7 +866,7 @@ def plot_freq(series,sampling_frequency=1):
     """
         Purpose: Illustrate the power spectrum calculation for a given data series
         Inputs: series-A data array to show the power spectrum for. Calls power_spectrum
-                sampling_frequency-(optional) IDK what for yet
+                sampling_frequency-(optional) samples per second [Hz]
         Outputs: none
     """
     t=sp.arange(0,len(series))/(1.0*sampling_frequency)
@@ -573,18 +876,12 @@ def plot_freq(series,sampling_frequency=1):
     pylab.ylabel('Amplitude')
     pylab.subplot(2,1,2)
 
-    n = len(series)             # length of the signal
-    k = sp.arange(n)
-    T = n/sampling_frequency
-    frq = k/T                   # two sides frequency range
-    frq = frq[range(n/2)]       # one side frequency range
-
-    Y = np.fft.fft(series)/n    # fft computing and normalization
-    Y = Y[range(n/2)]
+    # Amplitude spectral density, from the same Welch spectrum as plot_power
+    (frq,power) = power_spectrum(series,sampling_frequency=sampling_frequency)
 
-    pylab.plot(frq,abs(Y),'r') # plotting the spectrum
+    pylab.loglog(frq[1:],np.sqrt(power[1:]),'r') # plotting the spectrum
     pylab.xlabel('Freq (Hz)')
-    pylab.ylabel('|Y(freq)|')
+    pylab.ylabel('|Y(freq)| [units/sqrt(Hz)]')
     pylab.show()
 
 
@@ -0,0 +1,94 @@
+#
+# Script name: frobomad_benchmark.py
+# Description: Times the column by column frobomad in centroid on a 1080x2560 half
+# frame, for uint16 and float frames, against the original loop over the columns
+# (the per column hist_median frobomad), and checks that they agree. The 100 ms
+# target holds for integer frames only; float frames take the masked reductions.
+#
+
+###################################################################################
+# Must import this for every script in this directory in order to use our modules!!
+###################################################################################
+import script_setup
+
+###################################################################################
+# Import modules from analysis (the correct way to do it):
+###################################################################################
+from analysis import centroid as centroid
+import numpy as np
+import time
+
+###################################################################################
+# Functions
+###################################################################################
+def timeit(func, *args, **kwargs):
+    '''
+    Returns the best wall clock time of a few calls to func(*args, **kwargs), and its result.
+    '''
+    best = None
+    for ii in range(5):
+        tic = time.time()
+        result = func(*args, **kwargs)
+        toc = time.time()
+        if best is None or toc - tic < best:
+            best = toc - tic
+    return best, result
+
+def baseline_hist_median(image):
+    '''
+    The original histogram median (one python step per histogram bin).
+    '''
+    n = np.size(image)/2
+    bins = np.bincount(image.ravel().astype(int))
+    
+    ind = 0
+    while n > 0:
+        n -= bins[ind]
+        ind += 1
+    
+    return float(ind-1)
+
+def baseline_frobomad(image, zvalue=3):
+    '''
+    The original frobomad of one column: fMAD from two histogram medians, then two
+    rounds of sigma clipping.
+    '''
+    m = baseline_hist_median(image)
+    s = baseline_hist_median(abs(image - m))
+    sd = 1.4826 * s
+    if (sd < 1.0e-14):
+        return(m, sd)
+    gdPix = np.where(abs(image - m) < (zvalue*sd))
+    m1 = np.mean(image[gdPix])
+    sd1 = np.std(image[gdPix])
+    gdPix = np.where(abs(image - m1) < (zvalue*sd1))
+    return(np.mean(image[gdPix]), np.std(image[gdPix]))
+
+def loop_frobomad(img):
+    '''
+    frobomad of every column, one column at a time, as the original axis=0 did.
+    '''
+    m = np.zeros(img.shape[1])
+    sd = np.zeros(img.shape[1])
+    for ii in range(img.shape[1]):
+        (m[ii], sd[ii]) = baseline_frobomad(img[:,ii])
+    return (m, sd)
+
+###################################################################################
+# Main
+###################################################################################
+# Half frame of background with a column gain pattern, some stars and hot pixels:
+gains = np.random.normal(1, 0.05, 2560)
+half = np.random.poisson(200, size=(1080, 2560))*gains
+half[np.random.randint(0, 1080, 500), np.random.randint(0, 2560, 500)] += 1500
+half = half.astype(np.uint16)
+
+t_loop, (m_loop, sd_loop) = timeit(loop_frobomad, half)
+t_vec, (m_vec, sd_vec) = timeit(centroid.frobomad, half, axis=0)
+t_flt, (m_flt, sd_flt) = timeit(centroid.frobomad, np.float32(half), axis=0)
+print 'frobomad of 2560 columns (target 100 ms, integer frames only)'
+print '  original column loop: %7.2f ms' % (1000*t_loop)
+print '  axis=0 (uint16):      %7.2f ms  %5.1fx' % (1000*t_vec, t_loop/t_vec)
+print '  axis=0 (float32):     %7.2f ms  %5.1fx' % (1000*t_flt, t_loop/t_flt)
+print '  max difference:       %g, %g' % (np.max(abs(m_loop - m_vec)), np.max(abs(sd_loop - sd_vec)))
+print '  max difference:       %g, %g (float32)' % (np.max(abs(m_loop - m_flt)), np.max(abs(sd_loop - sd_flt)))
@@ -0,0 +1,59 @@
+#
+# Script name: graycode_benchmark.py
+# Description: Times the lookup table gray to binary conversion in imgutil against
+# the original xor loop on a full 2160x2560 frame, and checks that they agree.
+#
+
+###################################################################################
+# Must import this for every script in this directory in order to use our modules!!
+###################################################################################
+import script_setup
+
+###################################################################################
+# Import modules from analysis (the correct way to do it):
+###################################################################################
+from util import imgutil as imgutil
+import numpy as np
+import time
+
+###################################################################################
+# Functions
+###################################################################################
+def timeit(func, *args, **kwargs):
+    '''
+    Returns the best wall clock time of a few calls to func(*args, **kwargs), and its result.
+    '''
+    best = None
+    for ii in range(5):
+        tic = time.time()
+        result = func(*args, **kwargs)
+        toc = time.time()
+        if best is None or toc - tic < best:
+            best = toc - tic
+    return best, result
+
+###################################################################################
+# Main
+###################################################################################
+# Random 11 bit, gray coded full frame:
+frame = imgutil.bimg2gimg(np.random.randint(0, 2**11, size=(2160, 2560)).astype(np.uint16))
+out = np.empty_like(frame)
+
+# Build the table up front, it is cached after the first call:
+imgutil.graytable()
+
+t_loop, b_loop = timeit(imgutil.gimg2bimg_xor, frame)
+t_lut, b_lut = timeit(imgutil.gimg2bimg, frame)
+t_out, b_out = timeit(imgutil.gimg2bimg, frame, out=out)
+print 'gray -> binary'
+print '  xor loop:        %7.2f ms' % (1000*t_loop)
+print '  lookup:          %7.2f ms' % (1000*t_lut)
+print '  lookup (out=):   %7.2f ms' % (1000*t_out)
+print '  identical:       ' + str(np.array_equal(b_loop, b_lut) and np.array_equal(b_loop, b_out))
+
+t_xor, g_xor = timeit(imgutil.bimg2gimg, b_loop)
+t_out, g_out = timeit(imgutil.bimg2gimg, b_loop, out=out)
+print 'binary -> gray'
+print '  xor:             %7.2f ms' % (1000*t_xor)
+print '  xor (out=):      %7.2f ms' % (1000*t_out)
+print '  identical:       ' + str(np.array_equal(g_xor, g_out))
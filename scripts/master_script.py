@@ -37,20 +37,20 @@ import copy as cp
 def getCentroids(fnames):
     '''True
     From a list of filenames, load the filenames, clean up the images, find stars
-    in the images, and return a list of centroids and the number of stars found in
-    each image.
+    in the images, and return a list of centroids, the number of stars found in
+    each image and a list of the star fluxes (the same order as the centroids).
     '''
     
     n = len(fnames)
     centroids = []
     numstars = []
-    for count,fname in enumerate(fnames):
+    fluxes = []
+    # Frames are read ahead in the background while we centroid:
+    images = imgutil.BurstReader(fnames)
+    for count,(fname,image) in enumerate(izip(fnames,images)):
         # Display status:
         print 'Loading and centroiding filename ' + str(count+1) + ' of ' + str(n) + '.'
         
-        # Load the image:
-        image = imgutil.loadimg(fname,from_database=True)
-        
         # Clean up image, if it hasn't been already:
         if not fname.find('_norm.tif'):
             image = flatfield.ImgNormalize(image, Method="mean")
@@ -58,36 +58,52 @@ def getCentroids(fnames):
         # Find stars in image:
         #centers = centroid.findstars(image)
         # Nighttime:
-        centers = centroid.findstars(image,zreject=4, zthresh=3.2, zpeakthresh=5, min_pix_per_star=6, max_pix_per_star=60, oblongness=2,debug=False)
+        centers = centroid.findstars(image,zreject=4, zthresh=3.2, zpeakthresh=5, min_pix_per_star=6, max_pix_per_star=60, oblongness=2,debug=False,backend="label")
         # Daytime:        
-        #centers = centroid.findstars(image,zreject=3, zthresh=3.0, zpeakthresh=4, min_pix_per_star=6, max_pix_per_star=60, oblongness=2,debug=False)
+        #centers = centroid.findstars(image,zreject=3, zthresh=3.0, zpeakthresh=4, min_pix_per_star=6, max_pix_per_star=60, oblongness=2,debug=False,backend="label")
         
-        # Get centroids:
-        centroids.append(centroid.imgcentroid(image,centers))
+        # Get centroids (all stars of the frame at once):
+        stars = centroid.batchcentroid(image,centers)
+        # Drop stars with no flux, and those across the sensor middle (one background
+        # for a window that spans both readout halves):
+        stars = stars[(stars['status'] & (centroid.CENT_NOFLUX | centroid.CENT_STRADDLE)) == 0]
+        centroids.append(zip(stars['x'].tolist(),stars['y'].tolist()))
+        fluxes.append(stars['flux'].tolist())
         
         # store number of stars centroided per frame
         numstars.append(len(centroids[count]))
         
-    return centroids,numstars
+    return centroids,numstars,fluxes
  
-def getQuaternions(centroids):
+def getQuaternions(centroids,robust=False,fluxes=None):
     '''
     From a list of centroids found in successive image files, return a list of quaternions
-    representing the rotations between the image files
+    representing the rotations between the image files. With robust=True each frame pair
+    is solved with the RANSAC q-method, so a bad star match is left out of its quaternion.
+    Given the star fluxes of every frame (from getCentroids), each matched star is weighted
+    by the geometric mean of its fluxes in the two frames, so bright stars count for more.
     '''
     print 'Matching stars.'
     matched_centroids = []
     centroid_pairs = []
+    weights = []
     nummatchstars = []
     search_radius = 5
-    for count,(centlistA,centlistB) in enumerate(izip(centroids, islice(centroids, 1, None))):
+    # Star positions of every frame as (N,2) arrays:
+    positions = [np.reshape(np.array(centlist, dtype=np.float64), (-1,2)) for centlist in centroids]
+    for count,(centlistA,centlistB) in enumerate(izip(positions, islice(positions, 1, None))):
         
         print 'Comparing centroid list: ' + str(count+1) + ' to ' + str(count+2) + '.'
-        pair = starmatcher.matchstars(centlistA,centlistB,search_radius)
+        (ia, ib) = starmatcher.matchindices(centlistA,centlistB,search_radius)
+        pair = zip(map(tuple, centlistA[ia]), map(tuple, centlistB[ib]))
         
         if pair:
             centroid_pairs.append(pair)
             matched_centroids.append(zip(*pair)[0])
+            if fluxes is not None:
+                weights.append(np.sqrt(np.abs(np.asarray(fluxes[count])[ia]*np.asarray(fluxes[count+1])[ib])))
+            else:
+                weights.append(None)
             
         nummatches = len(pair)
         nummatchstars.append(nummatches)
@@ -101,14 +117,23 @@ def getQuaternions(centroids):
     print 'Mean number of matched stars:', np.mean(nummatchstars)
 
     print 'Find quaternions.'
-    quats = []
-    for (count,matched) in enumerate(centroid_pairs):
-        # Project 2d vectors into 3d space:
-        Vi2d,Vb2d = zip(*matched)
-        Vi = starmatcher.project3D(Vi2d)
-        Vb = starmatcher.project3D(Vb2d)
-        # Run the Q-Method:
-        quats.append(qmethod.qmethod(Vi,Vb))
+    # Legacy project3D() camera (see its docstring), built once for every pair:
+    camera = starmatcher.CameraModel(f=150000, plate_scale=1, cx=6.5*2560/2., cy=6.5*2160/2.)
+    # Project the 2d pairs into 3d space, (N,2,3) per frame pair:
+    V = [starmatcher.project3D(matched, camera=camera) for matched in centroid_pairs]
+    if robust:
+        # Inliers within 1e-5 rad, about 1.5 pixels with this camera:
+        quats = []
+        for (count,(v,w)) in enumerate(izip(V,weights)):
+            q,inliers,res = qmethod.robustqmethod(v[:,0],v[:,1],W=w,threshold=1e-5)
+            if not inliers.all():
+                print 'Frame pair ' + str(count+1) + ': ' + str(np.sum(~inliers)) + ' outlier matches.'
+            quats.append(q)
+    else:
+        # Run the Q-Method on all frame pairs at once:
+        Vi = qmethod.padvectors([v[:,0] for v in V])
+        Vb = qmethod.padvectors([v[:,1] for v in V])
+        quats = list(qmethod.qmethod_batch(Vi,Vb))
      
     return quats,matched_centroids,nummatchstars
 
@@ -129,6 +154,7 @@ plot = True
 burst_num = 172
 load_centroids = True   # Try to load from database. If FALSE, all database data will be overwritten.
 load_quats = True       # Try to load from database
+robust_quats = False    # Reject bad star matches (RANSAC q-method) when computing quaternions
 compute_centroids = not load_centroids
 compute_quats = not load_quats
 
@@ -158,7 +184,9 @@ fnames.sort()
 print 'Starting analysis.'
 tic = time.clock()
 
-# Get centroids from each file:
+# Get centroids from each file (star fluxes only come with newly computed centroids,
+# the database holds just the positions):
+fluxes = None
 if load_centroids:
     print "Trying to load Centroids from Database"
     centroids = db.find_centroids("burst_num = %s" % burst_num)
@@ -169,7 +197,7 @@ if load_centroids:
 
 if compute_centroids:
     print "Computing centroids for each image"
-    centroids,numstars = getCentroids(fnames)
+    centroids,numstars,fluxes = getCentroids(fnames)
     # update centroid list into the database
     print "Inserting centroid lists and number of stars into the database"
     for count,cent in enumerate(centroids):
@@ -201,7 +229,7 @@ if load_quats:
 
 if compute_quats:
     print "Computing quaternions for each image"
-    quats,matched_centroids,nummatchstars = getQuaternions(centroids)
+    quats,matched_centroids,nummatchstars = getQuaternions(centroids,robust=robust_quats,fluxes=fluxes)
     # update quaternions into the database
     print"Inserting quaterninos, number of matched stars, and matched stars into the database"
     for count,q in enumerate(quats):
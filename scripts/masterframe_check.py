@@ -0,0 +1,71 @@
+#
+# Script name: masterframe_check.py
+# Description: Checks the streaming MasterFrameBuilder in flatfield against the
+# median and sigma-clipped mean of the whole stack (np.median, np.percentile), for
+# flat and dark levels, a drifting burst and frames with cosmic rays.
+#
+
+###################################################################################
+# Must import this for every script in this directory in order to use our modules!!
+###################################################################################
+import script_setup
+
+###################################################################################
+# Import modules from analysis (the correct way to do it):
+###################################################################################
+from analysis import flatfield as flatfield
+import numpy as np
+import time
+
+###################################################################################
+# Functions
+###################################################################################
+def stack_clipped(stack, zvalue=3):
+    '''
+    Per-pixel mean of the stack within zvalue interquartile-range sigmas of the median,
+    the same clipping as MasterFrameBuilder.clipped().
+    '''
+    m = np.median(stack, axis=0)
+    (q25, q75) = np.percentile(stack, [25, 75], axis=0)
+    keep = abs(stack - m) <= zvalue*(q75 - q25)/1.349
+    return np.sum(stack*keep, axis=0)/np.sum(keep, axis=0)
+
+def check(name, stack, level):
+    '''
+    Builds the master frames of the stack one frame at a time and prints their
+    largest errors against the whole stack values, and against the true level next
+    to those of the whole stack values (their own sampling noise).
+    '''
+    tic = time.time()
+    builder = flatfield.MasterFrameBuilder().extend(stack)
+    toc = time.time()
+    median = np.median(stack, axis=0)
+    clipped = stack_clipped(stack)
+    print name + ' (%d frames, %.1f ms/frame)' % (len(stack), 1000*(toc - tic)/len(stack))
+    print '                   vs stack     vs level (stack vs level)'
+    for (label, ours, theirs) in (('median', builder.median(), median),
+                                  ('clipped', builder.clipped(), clipped),
+                                  ('mean', builder.mean(), clipped)):
+        print '  %-8s max error %7.2f DN %7.2f DN (%7.2f DN)' % (label,
+            np.max(abs(ours - theirs)), np.max(abs(ours - level)), np.max(abs(theirs - level)))
+
+###################################################################################
+# Main
+###################################################################################
+nframes = 200
+shape = (128, 128)
+
+def burst(level, drift=0, cosmics=0.002):
+    '''
+    Poisson frames around level (DN), drifting by drift DN over the burst, with a
+    fraction cosmics of the pixels of each frame hit by a cosmic ray.
+    '''
+    frames = np.random.poisson(level, size=(nframes,) + shape).astype(np.float64)
+    frames += drift*np.linspace(0, 1, nframes)[:, np.newaxis, np.newaxis]
+    hits = np.random.rand(*frames.shape) < cosmics
+    frames[hits] += np.random.uniform(500, 3000, hits.sum())
+    return np.uint16(frames)
+
+check('Flat, 1500 DN', burst(1500), 1500)
+check('Dark, 200 DN', burst(200), 200)
+check('Drifting flat, 1500 DN + 100 DN', burst(1500, drift=100), 1550)
@@ -0,0 +1,64 @@
+#
+# Script name: wiener_benchmark.py
+# Description: Times the Wiener filter in flatfield (separable box sums for the
+# default 3x3 window, FFTs for a large one) against scipy.signal.wiener over a burst
+# of 2160x2560 frames, and checks that they agree.
+#
+
+###################################################################################
+# Must import this for every script in this directory in order to use our modules!!
+###################################################################################
+import script_setup
+
+###################################################################################
+# Import modules from analysis (the correct way to do it):
+###################################################################################
+from analysis import flatfield as flatfield
+from scipy import signal as signal
+import numpy as np
+import time
+
+###################################################################################
+# Functions
+###################################################################################
+def run_burst(func, burst, **kwargs):
+    '''
+    Returns the wall clock time per frame of func(frame, **kwargs) over the burst,
+    and the last result.
+    '''
+    tic = time.time()
+    for frame in burst:
+        result = func(frame, **kwargs)
+    toc = time.time()
+    return (toc - tic)/len(burst), result
+
+###################################################################################
+# Main
+###################################################################################
+# Burst of background frames with a column gain pattern and a few stars:
+nframes = 5
+gains = np.random.normal(1, 0.05, 2560)
+burst = []
+for ii in range(nframes):
+    frame = np.random.poisson(200, size=(2160, 2560))*gains
+    frame[np.random.randint(0, 2160, 300), np.random.randint(0, 2560, 300)] += 1500
+    burst.append(frame)
+
+# The first call for a frame size sets up the cached edge weights and transfer function:
+flatfield.fastwiener(burst[0])
+flatfield.fastwiener(burst[0], dtype=np.float32)
+flatfield.fastwiener(burst[0], mysize=17)
+
+t_ref, w_ref = run_burst(signal.wiener, burst)
+t_64, w_64 = run_burst(flatfield.fastwiener, burst)
+t_32, w_32 = run_burst(flatfield.fastwiener, burst, dtype=np.float32)
+print 'Wiener filter, %d frames' % nframes
+print '  signal.wiener:      %7.1f ms/frame' % (1000*t_ref)
+print '  fastwiener:         %7.1f ms/frame   max difference %g' % (1000*t_64, np.max(abs(w_64 - w_ref)))
+print '  fastwiener float32: %7.1f ms/frame   max difference %g' % (1000*t_32, np.max(abs(w_32 - w_ref)))
+
+t_ref, w_ref = run_burst(signal.wiener, burst, mysize=17)
+t_17, w_17 = run_burst(flatfield.fastwiener, burst, mysize=17)
+print 'Wiener filter, 17x17 window, %d frames' % nframes
+print '  signal.wiener:      %7.1f ms/frame' % (1000*t_ref)
+print '  fastwiener:         %7.1f ms/frame   max difference %g' % (1000*t_17, np.max(abs(w_17 - w_ref)))
@@ -8,24 +8,26 @@ import PIL.Image as TIFF
 import matplotlib.pyplot as plt
 import pylab as pl
 import os
+import numbers
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 
 # ------------------------------- Load Image ---------------------------------
 # loadimg(): loads a tiff, dat, or array into memory
 # returns numpy array of 16 bit integers
-def loadimg(filename, from_database=False, load_full=False):    
+def loadimg(filename, from_database=False, load_full=False, memmap=False):    
     '''loadimg(): Loads *.tif and *.dat files and returns them as numpy nmarrays.
     Requires: numpy, libtiff, and pyFITS.
+    Set memmap=True to read *.dat files through a memory map instead of np.fromfile
+    (see loaddat()).
     JD, DayStar, 10/10/12'''
     
     # Is it a picture?
     try:
         if from_database:
-            daystar_root = os.environ.get('RawBaseLoc')
-            if daystar_root:
-                filename = daystar_root + '/' + filename
-            else:
-                raise RuntimeError('Your "RawBaseLoc" environment variable does not seem to be set!')
+            filename = rawpath(filename)
             
         imgtype = filetype(filename) # what type of file is it?
         # TIF file type
@@ -37,9 +39,9 @@ def loadimg(filename, from_database=False, load_full=False):
         # Dat file type    
         elif (imgtype == 'dat'):
             if load_full:
-                imgout = loadfulldat(filename)
+                imgout = loadfulldat(filename, memmap=memmap)
             else:
-                imgout = loaddat(filename)
+                imgout = loaddat(filename, memmap=memmap)
             return imgout
         
         elif (imgtype == 'fits'):
@@ -58,27 +60,78 @@ def loadimg(filename, from_database=False, load_full=False):
 
 # ----- loadimg() supporting functions ---------
 
+# database file names
+def rawpath(filename):
+    '''rawpath(): returns the full path of a file name stored in the database (raw_fn, 
+    norm_fn), which are relative to the "RawBaseLoc" environment variable.'''
+    daystar_root = os.environ.get('RawBaseLoc')
+    if daystar_root:
+        return daystar_root + '/' + filename
+    else:
+        raise RuntimeError('Your "RawBaseLoc" environment variable does not seem to be set!')
+
 # graycode
-def gimg2bimg(imgArray,numbits=11):
+# Every pixel is a uint16, so gray to binary conversion is done with one lookup into
+# a 2^16 entry table instead of a pass over the whole frame per bit. The table is 
+# built once (per numbits) by running the original xor loop over every possible 
+# value, so the lookup results are identical to the loop.
+_graytables = {}
+
+def graytable(numbits=11):
+    '''graytable(): Returns the cached uint16 lookup table for gray to binary
+    conversion of uint16 pixel values.'''
+    if numbits not in _graytables:
+        _graytables[numbits] = gimg2bimg_xor(np.arange(2**16, dtype=np.uint16), numbits)
+    return _graytables[numbits]
+
+def gimg2bimg(imgArray, numbits=11, out=None):
+    '''gimg2bimg(): gray to binary conversion of a uint16 image with a single table 
+    lookup. If out is given (a uint16 array of the same shape, which may be imgArray 
+    itself) the result is written into it and no new image is allocated.'''
+    if imgArray.dtype != np.uint16:
+        bimg = gimg2bimg_xor(imgArray, numbits)
+        if out is None:
+            return bimg
+        out[...] = bimg
+        return out
+    return np.take(graytable(numbits), imgArray, out=out, mode='clip')
+
+def gimg2bimg_xor(imgArray,numbits=11):
+    '''gimg2bimg_xor(): the original bitwise gray to binary conversion loop. Used to
+    build the lookup table, for non uint16 images, and as a benchmark reference.'''
     for i in xrange(1,numbits):
         imgArray = np.bitwise_xor(imgArray,np.right_shift(imgArray,i))
     return imgArray
 
-def bimg2gimg(imgArray):
-    return np.bitwise_xor(np.right_shift(imgArray,1),imgArray)
+def bimg2gimg(imgArray, out=None):
+    '''bimg2gimg(): binary to gray conversion. This is a single xor pass, which is 
+    already faster than a table lookup; out behaves as in gimg2bimg().'''
+    return np.bitwise_xor(np.right_shift(imgArray,1),imgArray,out=out)
 
 # check image file type
 def filetype(file):
     return file.split(".")[-1]
 
-def loaddat(filename):
+def loaddat(filename, memmap=False, out=None):
     '''loaddat(): Loads the image pixel data from a *.dat file created by DAYSTAR 
     into a numpy array.
     This routine ASSUMES that the row size is 2560 + 32 overscan pixels = 2592.
     It ASSUMES that the number of rows is 2160 + 32 = 2192. It assumed 16 bits
     per pixel. Values are scaled from 11 bit to 16 bit units and converted from 
     uint16 gray code to uint16 binary. A cropped 2160x2560 image is returned.
+    If memmap is set, the file is mapped with mapdat() and only the cropped image 
+    area is ever read out of it, gray decoded straight into the returned array.
+    If out (a 2160x2560 uint16 array) is given, the image is decoded into it.
     JD, DayStar, 10/15/12'''
+    if out is None:
+        out = np.empty((2160, 2560), dtype='uint16')
+
+    if memmap:
+        top, bott = cropviews(mapdat(filename))
+        gimg2bimg(top, out=out[0:1080])     # gray to binary conversion, read
+        gimg2bimg(bott, out=out[1080:2160]) # straight out of the page cache
+        return out
+
     fileopen = open(filename, mode='rb') # Open the file in binary read mode.
     
     xdim = 2560 + 32
@@ -88,19 +141,25 @@ def loaddat(filename):
     
     data = np.fromfile(fileopen, pixT, nPix)# load the data following the header
     data.shape = (ydim, xdim)               # reshape the data stream as a 2-D array
-    data = cropimg(data)                    # crop image to 2160x2560
-    data = gimg2bimg(data)                  # gray to binary conversion
-    fileopen.close
-    return data
+    fileopen.close()
+    top, bott = cropviews(data)             # crop image to 2160x2560 and
+    gimg2bimg(top, out=out[0:1080])         # gray to binary conversion
+    gimg2bimg(bott, out=out[1080:2160])
+    return out
 
-def loadfulldat(filename):
+def loadfulldat(filename, memmap=False, out=None):
     '''loaddatfull(): Loads the image pixel data from a *.dat file created by DAYSTAR 
     into a numpy array.
     This routine ASSUMES that the row size is 2560 + 32 overscan pixels = 2592.
     It ASSUMES that the number of rows is 2160 + 32 = 2192. It assumed 16 bits
     per pixel. Values are scaled from 11 bit to 16 bit units and converted from 
     uint16 gray code to uint16 binary. Full 2192x2592 image is returned.
+    If memmap is set, the gray code conversion reads directly from mapdat().
+    If out (a 2192x2592 uint16 array) is given, the image is decoded into it.
     JD, DayStar, 10/15/12'''
+    if memmap:
+        return gimg2bimg(mapdat(filename), out=out)  # gray to binary conversion
+
     fileopen = open(filename, mode='rb') # Open the file in binary read mode.
     
     xdim = 2560 + 32
@@ -110,10 +169,19 @@ def loadfulldat(filename):
     
     data = np.fromfile(fileopen, pixT, nPix)# load the data following the header
     data.shape = (ydim, xdim)               # reshape the data stream as a 2-D array
-    data = gimg2bimg(data)                  # gray to binary conversion
-    fileopen.close
+    fileopen.close()
+    data = gimg2bimg(data, out=out)         # gray to binary conversion
     return data
 
+def mapdat(filename, mode='c'):
+    '''mapdat(): Memory maps the raw (still gray coded) pixel data of a *.dat file 
+    created by DAYSTAR as a 2192x2592 uint16 array. Nothing is read until the pixels 
+    are touched, and the pages are shared through the OS page cache. The default 
+    copy-on-write mode lets a caller modify the array without copying the frame up 
+    front or changing the file; use mode='r' for a strictly read-only map.'''
+    xdim = 2560 + 32
+    ydim = 2160 + 32
+    return np.memmap(filename, dtype='uint16', mode=mode, shape=(ydim, xdim))
 
 def loadtif(filename):
     '''loadtif(): Loads *.tif file and returns a numpy ndarray. Uses libtiff functions.
@@ -136,6 +204,106 @@ def cropimg(imgArray):
     img = np.vstack([top,bott])
     return img
 
+def cropviews(imgArray):
+    '''cropviews(): returns the top and bottom 1080x2560 image areas of a 2592x2192 
+    image as views (no copy). Together they are the image returned by cropimg().'''
+    top = imgArray[0:1080, 16:2560+16]
+    bott = imgArray[1080+32:2160+32, 16:2560+16]
+    return top, bott
+
+# ------------------------------- Burst Reader ----------------------------------
+class BurstReader(object):
+    '''BurstReader: iterates over the decoded frames of a burst in order. The frames
+    are loaded by a pool of threads that read up to "prefetch" frames ahead of the 
+    caller, so disk reads overlap with whatever is done with each frame.
+    
+    burst is either a burst number, whose raw_fn file names are looked up with 
+    db.RawData.Connect(), or a list of file names. File names are relative to 
+    "RawBaseLoc" (see rawpath()) unless from_database is False. load_full returns
+    the full 2192x2592 frames, as in loadimg().
+    
+    >>> reader = imgutil.BurstReader(172)
+    >>> for count,image in enumerate(reader):
+    ...     centers = centroid.findstars(image)
+    >>> cube = reader.cube()        # (N, 2160, 2560) uint16 array of the whole burst
+    '''
+    def __init__(self, burst, from_database=True, load_full=False, prefetch=4, workers=2):
+        if isinstance(burst, numbers.Integral):
+            from db import RawData as database
+            db = database.Connect()
+            burst = db.select('select raw_fn from rawdata where burst_num = %s' % burst).raw_fn.tolist()
+            burst.sort()
+        
+        self.fnames = list(burst)
+        self.from_database = from_database
+        self.load_full = load_full
+        self.prefetch = max(1, prefetch)
+        self.workers = max(1, workers)
+        
+        if load_full:
+            self.shape = (2160 + 32, 2560 + 32)
+        else:
+            self.shape = (2160, 2560)
+    
+    def __len__(self):
+        return len(self.fnames)
+    
+    def __iter__(self):
+        '''Yields the decoded frames in the order of self.fnames.'''
+        return self._run(self.load)
+    
+    def cube(self, out=None):
+        '''cube(): Loads every frame of the burst into one (N, rows, cols) uint16 array,
+        allocated once up front (or into out, if given). Each frame is decoded straight 
+        into its slice of the cube.'''
+        if out is None:
+            out = np.empty((len(self.fnames),) + self.shape, dtype='uint16')
+        elif out.shape != (len(self.fnames),) + self.shape:
+            raise RuntimeError('BurstReader.cube(): out must have shape ' + str((len(self.fnames),) + self.shape))
+        
+        load = lambda (count, fname): self.load(fname, out=out[count])
+        for frame in self._run(load, enumerate(self.fnames)):
+            pass
+        return out
+    
+    def load(self, fname, out=None):
+        '''load(): loads and decodes a single frame of the burst.'''
+        if self.from_database:
+            fname = rawpath(fname)
+        
+        # The read-ahead relies on np.fromfile, which releases the GIL while it reads.
+        # Frames read through a memmap are only paged in during the gray code lookup,
+        # which would hold the GIL and serialize the workers.
+        if filetype(fname) == 'dat':
+            if self.load_full:
+                return loadfulldat(fname, out=out)
+            else:
+                return loaddat(fname, out=out)
+        
+        image = loadimg(fname)
+        if out is None:
+            return image
+        out[...] = image
+        return out
+    
+    def _run(self, load, items=None):
+        '''Maps load over items (default: self.fnames) on the thread pool, keeping at most
+        self.prefetch loads in flight, and yields the results in order.'''
+        if items is None:
+            items = self.fnames
+        items = iter(items)
+        pool = ThreadPool(self.workers)
+        try:
+            pending = deque(pool.apply_async(load, (item,)) for item in islice(items, self.prefetch))
+            while pending:
+                frame = pending.popleft().get()
+                # Refill the queue before handing the frame back
+                for item in islice(items, 1):
+                    pending.append(pool.apply_async(load, (item,)))
+                yield frame
+        finally:
+            pool.terminate()
+
 # -----------------------------Display Image-------------------------------------
 def dispimg(imgArray, viewfactor=1, fignum=None):
     '''dispimg(): uses pylab, imshow to display a numpy ndarray. viewfactor multiplies